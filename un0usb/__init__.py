@@ -1,7 +1,16 @@
 from un0usb.csr_map import CsrMap
-from un0usb.fpga_ctrl import FpgaControl, Acquisition
+from un0usb.fpga_ctrl import FpgaControl, Acquisition, AcquisitionTimeoutError
 from un0usb.ftdi_dev import FtdiDevice
+from un0usb.emulator import EmuDevice
 from un0usb.viz import FView
+from un0usb.acq_pipeline import AcquisitionPipeline
+from un0usb.async_ctrl import AsyncFpgaControl
+from un0usb.multi_board import MultiBoardManager, discover_boards
+from un0usb.recorder import Recorder, RecordingReader
+from un0usb.shm_ring import FrameRingWriter, FrameRingReader
+from un0usb.stream_server import StreamServer, StreamClient
+from un0usb.capture import Capture, load_capture
+from un0usb.stats import Instrumentation
 from un0usb.continuous_display import init_un0rick,continuous_acq
 from .version import __version__
 
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Threaded acquisition pipeline: one thread owns the un0rick board and
+    keeps acquisitions flowing, worker threads convert and process the
+    acquired lines, results are read by the caller (e.g. the display).
+
+    Stages are connected with bounded queues. When a queue is full, the
+    'drop_oldest' policy discards the oldest frame (and counts it), while
+    the 'block' policy makes the upstream stage wait.
+"""
+import queue
+import threading
+import time
+
+import numpy as np
+
+from . import signal_utils as sigutils
+
+DROP_OLDEST = "drop_oldest"
+BLOCK = "block"
+
+
+class Frame(object):
+    """One acquisition going through the pipeline"""
+
+    def __init__(self, seq, timestamp, lines, buffer):
+        self.seq = seq
+        self.timestamp = timestamp
+        # raw (n, 16384) uint16 lines, a view of 'buffer'
+        self.lines = lines
+        self.buffer = buffer
+        # (time, data) array from signal_utils.process_data
+        self.result = None
+
+
+def put_frame(que, frame, policy, stop, on_drop=None):
+    """Put frame in a bounded queue with the backpressure policy.
+
+    Parameters
+    ----------
+    que : queue.Queue
+        Destination queue.
+
+    policy : str
+        'block' waits for a free slot, 'drop_oldest' discards the oldest
+        queued frames to make room.
+
+    stop : threading.Event
+        Give up (the frame is not queued) once set.
+
+    on_drop : callable
+        Called as on_drop(frame) for every dropped frame.
+
+    Return
+    ------
+    bool
+        True if the frame was queued.
+    """
+    while not stop.is_set():
+        try:
+            que.put_nowait(frame)
+            return True
+        except queue.Full:
+            pass
+        if policy == BLOCK:
+            try:
+                que.put(frame, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        try:
+            dropped = que.get_nowait()
+        except queue.Empty:
+            continue
+        if on_drop is not None:
+            on_drop(dropped)
+    return False
+
+
+def get_frame(que, timeout=None, error=None):
+    """Return the next frame of a queue filled by worker threads.
+
+    Parameters
+    ----------
+    que : queue.Queue
+        Source queue.
+
+    timeout : float
+        Seconds to wait, forever if None (raises queue.Empty on timeout).
+
+    error : callable
+        Returns the error of a failed worker thread, raised as soon as it
+        is set (None while all is well).
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        if error is not None and error() is not None:
+            raise error()
+        wait = 0.1 if deadline is None else min(0.1, deadline - time.monotonic())
+        if wait <= 0:
+            raise queue.Empty
+        try:
+            return que.get(timeout=wait)
+        except queue.Empty:
+            continue
+
+
+class AcquisitionPipeline(object):
+    """Producer/consumer acquisition engine around a FpgaControl"""
+
+    def __init__(self, fpga, acq_lines=32, double_rate=True, gain=None,
+                 queue_size=4, workers=1, policy=DROP_OLDEST, dtype=np.float32):
+        """
+        Parameters
+        ----------
+        fpga : FpgaControl
+            Initialized board, only used by the acquisition thread once started.
+
+        acq_lines, double_rate, gain :
+            Acquisition settings, see FpgaControl.do_acquisition.
+
+        queue_size : int
+            Depth of the raw and processed frames queues.
+
+        workers : int
+            Number of processing threads. With more than one, results may
+            come out of order (see Frame.seq).
+
+        policy : str
+            'drop_oldest' or 'block' when a queue is full.
+
+        dtype :
+            Voltage dtype used for processing (np.float32 or np.float64).
+        """
+        if policy not in (DROP_OLDEST, BLOCK):
+            raise ValueError("Unknown backpressure policy: %s" % policy)
+        self.fpga = fpga
+        self.acq_lines = acq_lines
+        self.double_rate = double_rate
+        self.gain = gain
+        self.policy = policy
+        self.dtype = dtype
+        self.workers = workers
+        self.t_axis = sigutils.time_axis(fpga.WORDS_PER_LINE, False, fpga.SAMPLE_CLOCK)
+
+        self._raw = queue.Queue(queue_size)
+        self._out = queue.Queue(queue_size)
+        # raw buffers are recycled: one per queue slot, per worker and for the producer
+        self._free = queue.Queue()
+        for _ in range(queue_size + workers + 1):
+            self._free.put(fpga.alloc_lines(acq_lines))
+
+        self._stop = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+        self.error = None
+        self.acquired = 0
+        self.processed = 0
+        self.delivered = 0
+        self.dropped_raw = 0
+        self.dropped_out = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def __iter__(self):
+        while True:
+            yield self.get()
+
+    def start(self):
+        """Start acquisition and processing threads"""
+        self._stop.clear()
+        self._threads = [threading.Thread(target=self._run, args=(self._acquire,),
+                                          name="un0rick-acq", daemon=True)]
+        for i in range(self.workers):
+            self._threads += [threading.Thread(target=self._run, args=(self._process,),
+                                               name="un0rick-proc%d" % i, daemon=True)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=2.0):
+        """Stop all threads"""
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    @property
+    def running(self):
+        """True while the pipeline threads are alive"""
+        return any(thread.is_alive() for thread in self._threads)
+
+    def get(self, timeout=None):
+        """Return the next processed Frame.
+
+        Raises the error of a failed pipeline thread, or queue.Empty on timeout.
+        """
+        frame = get_frame(self._out, timeout, lambda: self.error)
+        with self._lock:
+            self.delivered += 1
+        return frame
+
+    def stats(self):
+        """Return pipeline counters as a dictionnary"""
+        with self._lock:
+            return {"acquired": self.acquired,
+                    "processed": self.processed,
+                    "delivered": self.delivered,
+                    "dropped_raw": self.dropped_raw,
+                    "dropped_out": self.dropped_out,
+                    "raw_queue": self._raw.qsize(),
+                    "out_queue": self._out.qsize()}
+
+    def _run(self, stage):
+        """Run a stage until stopped, recording its error"""
+        try:
+            while not self._stop.is_set():
+                stage()
+        except Exception as exc:  # pylint: disable=broad-except
+            self.error = exc
+            self._stop.set()
+
+    def _put(self, que, frame, counter):
+        """Put frame in queue with the backpressure policy, counting and
+        recycling the dropped frames in 'counter'"""
+        def on_drop(dropped):
+            with self._lock:
+                setattr(self, counter, getattr(self, counter) + 1)
+            self._recycle(dropped)
+        put_frame(que, frame, self.policy, self._stop, on_drop)
+
+    def _recycle(self, frame):
+        """Give back the raw buffer of a frame"""
+        if frame.buffer is not None:
+            self._free.put(frame.buffer)
+            frame.buffer = None
+
+    def _acquire(self):
+        """Acquisition stage: the only user of the board"""
+        try:
+            buf = self._free.get(timeout=0.1)
+        except queue.Empty:
+            return
+        lines = self.fpga.do_acquisition(acq_lines=self.acq_lines, gain=self.gain,
+                                         double_rate=self.double_rate, out=buf)
+        frame = Frame(self.acquired, time.time(), lines, buf)
+        with self._lock:
+            self.acquired += 1
+        self._put(self._raw, frame, "dropped_raw")
+
+    def _process(self):
+        """Processing stage: voltage conversion, averaging and interleaving"""
+        try:
+            frame = self._raw.get(timeout=0.1)
+        except queue.Empty:
+            return
+        signal = self.fpga.lines_to_voltage(frame.lines, dtype=self.dtype)
+        self._recycle(frame)
+        frame.lines = None
+        frame.result = sigutils.process_data({"signal": signal, "t": self.t_axis},
+                                             interleaved=self.double_rate)
+        with self._lock:
+            self.processed += 1
+        self._put(self._out, frame, "dropped_out")
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    asyncio facade over FpgaControl: every device access runs on one
+    dedicated I/O thread, so the event loop never blocks on USB transfers
+    or on the FPGA reset and reload delays, and acquisition completion is
+    awaited with asyncio sleeps between ACQDONE polls.
+
+        async with AsyncFpgaControl(FpgaControl(url, spi_freq=8E6)) as fpga:
+            await fpga.reload()
+            await fpga.reset()
+            async for frame in fpga.frames(acq_lines=32, double_rate=True):
+                ...
+"""
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .acq_pipeline import Frame
+from .fpga_ctrl import FpgaControl
+
+
+class AsyncFpgaControl(object):
+    """Awaitable acquisitions on a FpgaControl"""
+
+    def __init__(self, fpga):
+        """
+        Parameters
+        ----------
+        fpga : FpgaControl
+            Initialized board (or None, see open()). Once wrapped, only use
+            it through run() so that device accesses stay serialized on the
+            I/O thread.
+        """
+        self.fpga = fpga
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="un0usb-io")
+        self._acq_lock = None
+        self.acquired = 0
+
+    @classmethod
+    async def open(cls, ftdi_url='ftdi://ftdi:2232:/', spi_freq=8E6):
+        """Open the board (see FpgaControl) without blocking the loop"""
+        self = cls(None)
+        self.fpga = await self._run(FpgaControl, ftdi_url, spi_freq)
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def _run(self, func, *args, **kwargs):
+        """Future of func(*args, **kwargs) called on the I/O thread"""
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def run(self, func, *args, **kwargs):
+        """Call any blocking function on the I/O thread, e.g.
+        await fpga.run(fpga.fpga.set_pulseform, POn=16)"""
+        return await self._run(func, *args, **kwargs)
+
+    async def reset(self):
+        """Reset FPGA logic"""
+        await self._run(self.fpga.reset)
+
+    async def reload(self):
+        """Reload FPGA configuration from flash"""
+        await self._run(self.fpga.reload)
+
+    async def read_lines(self, n, out=None):
+        """Read 'n' lines from the board RAM, see FpgaControl.read_lines"""
+        return await self._run(self.fpga.read_lines, n, out)
+
+    async def acquire(self, acq_lines=1, gain=None, double_rate=False, out=None, timeout=None):
+        """Do an acquisition, like FpgaControl.do_acquisition.
+
+        The I/O thread is free while waiting for the acquisition end, so
+        other device accesses (through run()) can take place meanwhile;
+        acquisitions are serialized.
+
+        Return
+        ------
+        ndarray
+            (acq_lines, 16384) uint16 raw lines
+        """
+        if self._acq_lock is None:
+            self._acq_lock = asyncio.Lock()
+        async with self._acq_lock:
+            fpga = self.fpga
+            start = time.perf_counter()
+            await self._run(fpga.start_acquisition, acq_lines, gain, double_rate)
+            await self._wait(acq_lines, timeout)
+            lines = await self._run(fpga.read_lines, acq_lines, out)
+            if fpga.stats is not None:
+                fpga.stats.record('acquisition', time.perf_counter() - start)
+            self.acquired += 1
+            return lines
+
+    async def _wait(self, acq_lines, timeout=None):
+        """Await the end of the started acquisition, with the FpgaControl.wait_schedule policy"""
+        fpga = self.fpga
+        schedule = fpga.wait_schedule(acq_lines, timeout)
+        # the first step reads the pulser registers to predict the duration
+        delay = await self._run(next, schedule)
+        while True:
+            if delay > 0:
+                await asyncio.sleep(delay)
+            done = await self._run(lambda: fpga.csr.acqdone)
+            try:
+                delay = schedule.send(done)
+            except StopIteration as stop:
+                return stop.value
+
+    async def frames(self, acq_lines=32, gain=None, double_rate=True, count=None):
+        """Asynchronous iterator of acquisitions.
+
+        Parameters
+        ----------
+        acq_lines, gain, double_rate :
+            Acquisition settings, see FpgaControl.do_acquisition.
+
+        count : int
+            Number of frames, endless if None.
+
+        Yields
+        ------
+        acq_pipeline.Frame
+            seq, timestamp and raw lines of each acquisition.
+        """
+        seq = 0
+        while count is None or seq < count:
+            lines = await self.acquire(acq_lines, gain, double_rate)
+            yield Frame(seq, time.time(), lines, None)
+            seq += 1
+
+    async def close(self, disconnect=True):
+        """Stop the I/O thread, disconnecting the board first (if opened)"""
+        if disconnect and self.fpga is not None:
+            await self._run(self.fpga.disconnect)
+        # wait for the work still queued on the I/O thread without blocking the loop
+        await asyncio.get_running_loop().run_in_executor(None, self._executor.shutdown)
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Headless rendering of the FView JPG reports of many captures, across
+    a process pool, on matplotlib Agg canvases (no display needed):
+
+        python3 -m un0usb.batch_report captures/ -j 8
+        python3 -m un0usb.batch_report "runs/2020*/*.npz" -o reports/
+
+    A report is skipped when it is newer than its capture (--force to
+    render it again). Progress and throughput are printed as reports are
+    done; the exit status is 1 if any capture failed.
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from .capture import load_capture
+from .viz import FView
+
+# FView of the worker process, reused between captures
+_VIEW = None
+
+
+def find_captures(inputs, recursive=False):
+    """Return sorted .npz paths from directories, files and glob patterns"""
+    paths = set()
+    for entry in inputs:
+        if os.path.isdir(entry):
+            pattern = os.path.join(entry, "**", "*.npz") if recursive else os.path.join(entry, "*.npz")
+            paths.update(glob.glob(pattern, recursive=recursive))
+        elif os.path.isfile(entry):
+            paths.add(entry)
+        else:
+            paths.update(p for p in glob.glob(entry, recursive=recursive) if p.endswith(".npz"))
+    return sorted(paths)
+
+
+def _is_ndt(nblines, doublerate):
+    """True if FView.readfile renders the capture with plotNDT"""
+    return int(nblines) == 32 and int(doublerate) == 1
+
+
+def report_path(npz_path, out_dir=None, ndt=None):
+    """Path of the JPG report of a capture, next to it or in 'out_dir'.
+
+    Named like FView does: <capture>.jpg, or <capture>_ndt.jpg for 32
+    lines double rate captures. 'ndt' is read from the capture if None.
+    """
+    if ndt is None:
+        with np.load(npz_path) as npz:
+            ndt = _is_ndt(npz["nblines"], npz["doublerate"])
+    base = os.path.splitext(npz_path)[0]
+    if out_dir is not None:
+        base = os.path.join(out_dir, os.path.basename(base))
+    return base + ("_ndt.jpg" if ndt else ".jpg")
+
+
+def is_up_to_date(npz_path, out_dir=None):
+    """True if the report of the capture exists and is newer than it"""
+    report = report_path(npz_path, out_dir)
+    return os.path.exists(report) and os.path.getmtime(report) >= os.path.getmtime(npz_path)
+
+
+def _init_worker():
+    """Create the FView of the process: headless, reusing its figures.
+
+    Its figures are Agg canvases outside of pyplot, so the pyplot backend
+    and figures of the caller are untouched (workers=1 renders in-process).
+    """
+    global _VIEW
+    _VIEW = FView(reuse=True, headless=True)
+
+
+def render_report(npz_path, out_dir=None):
+    """Render the report of one capture. Return (report path, seconds)"""
+    if _VIEW is None:
+        _init_worker()
+    start = time.perf_counter()
+    data = dict(load_capture(npz_path))
+    ndt = _is_ndt(data["nblines"], data["doublerate"])
+    report = report_path(npz_path, out_dir, ndt)
+    # FView appends the suffix and extension to nameFile
+    data["nameFile"] = report[:-len("_ndt.jpg" if ndt else ".jpg")]
+    if ndt:
+        _VIEW.plotNDT(data, show=False)
+    else:
+        _VIEW.plotFirst(data, show=False)
+    return report, time.perf_counter() - start
+
+
+def batch_reports(paths, out_dir=None, workers=None, force=False, progress=None):
+    """Render the reports of all 'paths' captures.
+
+    Parameters
+    ----------
+    paths : list of str
+        .npz captures (see find_captures).
+    out_dir : str
+        Directory of the reports, next to the captures if None.
+    workers : int
+        Worker processes, os.cpu_count() if None. 1 renders in this process.
+    force : bool
+        Render reports even if up to date.
+    progress : callable
+        Called as progress(done, total, npz_path, report, error) after
+        every rendered capture; error is None on success.
+
+    Return
+    ------
+    dict
+        rendered, skipped, failed (list of (path, error)), elapsed_s and
+        reports_per_s.
+    """
+    start = time.perf_counter()
+    if out_dir is not None:
+        os.makedirs(out_dir, exist_ok=True)
+    todo = []
+    skipped = 0
+    for path in paths:
+        try:
+            if not force and is_up_to_date(path, out_dir):
+                skipped += 1
+                continue
+        except (OSError, KeyError, ValueError):
+            pass  # unreadable capture: reported as failed by the render
+        todo += [path]
+
+    rendered = 0
+    failed = []
+
+    def done(path, future_result):
+        nonlocal rendered
+        report, error = None, None
+        try:
+            report, _ = future_result()
+            rendered += 1
+        except Exception as exc:  # pylint: disable=broad-except
+            error = "%s: %s" % (type(exc).__name__, exc)
+            failed.append((path, error))
+        if progress is not None:
+            progress(rendered + len(failed), len(todo), path, report, error)
+
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        for path in todo:
+            done(path, lambda path=path: render_report(path, out_dir))
+    elif todo:
+        with ProcessPoolExecutor(max_workers=min(workers, len(todo)),
+                                 initializer=_init_worker) as pool:
+            futures = {pool.submit(render_report, path, out_dir): path for path in todo}
+            for future in as_completed(futures):
+                done(futures[future], future.result)
+
+    elapsed = time.perf_counter() - start
+    return {"rendered": rendered,
+            "skipped": skipped,
+            "failed": failed,
+            "elapsed_s": elapsed,
+            "reports_per_s": rendered / elapsed if elapsed else None}
+
+
+def _print_progress(start):
+    """Return a batch_reports progress callback printing to stdout"""
+    def progress(done, total, path, report, error):
+        rate = done / (time.perf_counter() - start)
+        status = "FAILED " + error if error else report
+        print("[%d/%d %.1f/s] %s -> %s" % (done, total, rate, path, status), flush=True)
+    return progress
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(description="Render the JPG reports of un0rick "
+                                                 "captures, headless and in parallel")
+    PARSER.add_argument("inputs",
+                        nargs="+",
+                        help="Capture directories, .npz files or glob patterns.")
+    PARSER.add_argument("-o", "--output",
+                        help="Reports directory, next to the captures by default.")
+    PARSER.add_argument("-j", "--jobs",
+                        type=int,
+                        help="Worker processes, one per CPU by default.")
+    PARSER.add_argument("-r", "--recursive",
+                        action="store_true",
+                        help="Look for captures in subdirectories.")
+    PARSER.add_argument("-f", "--force",
+                        action="store_true",
+                        help="Render reports even if up to date.")
+    PARSER.add_argument("-q", "--quiet",
+                        action="store_true",
+                        help="Only print the summary.")
+
+    ARGS = PARSER.parse_args()
+    PATHS = find_captures(ARGS.inputs, ARGS.recursive)
+    RES = batch_reports(PATHS, ARGS.output, ARGS.jobs, ARGS.force,
+                        None if ARGS.quiet else _print_progress(time.perf_counter()))
+    print("%d captures: %d rendered, %d up to date, %d failed in %.1fs (%.2f reports/s)" %
+          (len(PATHS), RES["rendered"], RES["skipped"], len(RES["failed"]),
+           RES["elapsed_s"], RES["reports_per_s"] or 0))
+    for FAILED_PATH, ERROR in RES["failed"]:
+        print("failed: %s (%s)" % (FAILED_PATH, ERROR), file=sys.stderr)
+    sys.exit(1 if RES["failed"] else 0)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Benchmark of the acquisition-to-display pipeline stages, run against
+    the board emulator (or a real board with --url):
+
+        python3 -m un0usb.benchmark -o results.json
+        python3 -m un0usb.benchmark --compare results.json
+
+    Every stage is timed on 1 and 32 lines, single and double rate.
+    Results: latency percentiles (ms), samples/s and bytes allocated (peak
+    traced by tracemalloc during one extra run).
+"""
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from .fpga_ctrl import FpgaControl
+from . import signal_utils as sigutils
+from .version import __version__
+
+STAGES = ("spi_decode", "read_lines", "line_to_voltage", "get_data",
+          "process_data", "plot", "save")
+CONFIGS = ((1, False), (1, True), (32, False), (32, True))
+
+
+def measure(func, repeat=20, warmup=2):
+    """Time 'func' calls.
+
+    Return
+    ------
+    dict
+        min, mean, p50, p90, p99, max latencies in ms, and peak bytes
+        allocated by one call.
+    """
+    for _ in range(warmup):
+        func()
+    times = np.empty(repeat)
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times[i] = time.perf_counter() - start
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    times *= 1E3
+    return {"min_ms": float(times.min()),
+            "mean_ms": float(times.mean()),
+            "p50_ms": float(np.percentile(times, 50)),
+            "p90_ms": float(np.percentile(times, 90)),
+            "p99_ms": float(np.percentile(times, 99)),
+            "max_ms": float(times.max()),
+            "alloc_bytes": int(peak)}
+
+
+def _plotter():
+    """Return a cvplotter.Plotter, None if opencv is not available"""
+    try:
+        from . import cvplotter
+    except ImportError:
+        return None
+    return cvplotter.Plotter((800, 500), (0, 256), (-1, 1))
+
+
+def bench_config(fpga, acq_lines, double_rate, repeat=20, stages=STAGES, workdir=None):
+    """Benchmark all stages for one acquisition configuration.
+
+    Captures are saved in 'workdir', a temporary directory if None.
+    """
+    if workdir is None:
+        with tempfile.TemporaryDirectory(prefix="un0usb-bench-") as tmpdir:
+            return bench_config(fpga, acq_lines, double_rate, repeat, stages, tmpdir)
+    results = {}
+    samples = acq_lines * fpga.WORDS_PER_LINE
+    raw = fpga.do_acquisition(acq_lines=acq_lines, double_rate=double_rate).copy()
+    payload = raw[0].astype('>u2').tobytes()
+    data = fpga.get_data()
+    processed = sigutils.process_data(data, interleaved=double_rate)
+    plotter = _plotter()
+
+    # RAMDATA decoding of CsrMap.ramdata, on the bytes of one line
+    funcs = {"spi_decode": (lambda: fpga.csr.decode_ramdata(fpga._ftdi._bytes_to_array(payload)),
+                            fpga.WORDS_PER_LINE),
+             "read_lines": (lambda: fpga.read_lines(acq_lines), samples),
+             "line_to_voltage": (lambda: fpga.lines_to_voltage(raw), samples),
+             "get_data": (fpga.get_data, samples),
+             "process_data": (lambda: sigutils.process_data(data, interleaved=double_rate), samples),
+             "plot": (lambda: plotter.render(processed), len(processed)) if plotter else None,
+             "save": (lambda: os.remove(fpga.save(os.path.join(workdir, "bench"))), samples)}
+    for stage in stages:
+        if funcs.get(stage) is None:
+            continue
+        func, n_samples = funcs[stage]
+        res = measure(func, repeat=repeat)
+        res["samples_per_s"] = n_samples / (res["mean_ms"] / 1E3) if res["mean_ms"] else None
+        results[stage] = res
+    return results
+
+
+def run(url="emu://?latency=0&bandwidth=0&realtime=0&seed=0", repeat=20,
+        configs=CONFIGS, stages=STAGES):
+    """Run the benchmark suite. Return results as a dictionnary"""
+    fpga = FpgaControl(url, spi_freq=8E6)
+    fpga.reload()
+    fpga.reset()
+    results = {"libversion": str(__version__),
+               "url": url,
+               "python": platform.python_version(),
+               "numpy": np.__version__,
+               "machine": platform.machine(),
+               "timestamp": time.time(),
+               "repeat": repeat,
+               "configs": {}}
+    with tempfile.TemporaryDirectory(prefix="un0usb-bench-") as workdir:
+        for acq_lines, double_rate in configs:
+            key = "%dl_%s" % (acq_lines, "dr" if double_rate else "sr")
+            results["configs"][key] = bench_config(fpga, acq_lines, double_rate, repeat,
+                                                   stages, workdir)
+    fpga.disconnect()
+    return results
+
+
+def report(results, reference=None):
+    """Format results as a text table, with ratios to 'reference' results"""
+    lines = ["%-10s %-16s %9s %9s %9s %12s %12s%s" %
+             ("config", "stage", "p50 ms", "p90 ms", "p99 ms", "Msamples/s", "alloc kB",
+              "  vs ref" if reference else "")]
+    for key, stages in results["configs"].items():
+        for stage, res in stages.items():
+            line = "%-10s %-16s %9.3f %9.3f %9.3f %12.2f %12.1f" % (
+                key, stage, res["p50_ms"], res["p90_ms"], res["p99_ms"],
+                (res["samples_per_s"] or 0) / 1E6, res["alloc_bytes"] / 1E3)
+            if reference:
+                ref = reference.get("configs", {}).get(key, {}).get(stage)
+                if ref and ref["p50_ms"]:
+                    line += "  x%.2f" % (res["p50_ms"] / ref["p50_ms"])
+            lines += [line]
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(description="Benchmark the un0usb "
+                                                 "acquisition pipeline stages")
+    PARSER.add_argument("-u", "--url",
+                        help="Device url, emulator without USB delays by default.",
+                        default="emu://?latency=0&bandwidth=0&realtime=0&seed=0")
+    PARSER.add_argument("-n", "--repeat",
+                        type=int,
+                        help="Timed runs per stage.",
+                        default=20)
+    PARSER.add_argument("-s", "--stages",
+                        nargs="+",
+                        choices=STAGES,
+                        help="Stages to benchmark.",
+                        default=STAGES)
+    PARSER.add_argument("-o", "--output",
+                        help="Save results to this JSON file.")
+    PARSER.add_argument("-c", "--compare",
+                        help="JSON results of a previous run to compare with.")
+
+    ARGS = PARSER.parse_args()
+    RESULTS = run(ARGS.url, ARGS.repeat, stages=ARGS.stages)
+    REFERENCE = None
+    if ARGS.compare:
+        with open(ARGS.compare) as ref_file:
+            REFERENCE = json.load(ref_file)
+    print(report(RESULTS, REFERENCE))
+    if ARGS.output:
+        with open(ARGS.output, "w") as out_file:
+            json.dump(RESULTS, out_file, indent=2)
@@ -0,0 +1,56 @@
+'''
+Loading of acquisitions saved by FpgaControl.save
+'''
+
+from collections.abc import Mapping
+
+import numpy as np
+
+
+def codes_to_voltage(codes, sample_w, v_ref, dtype=np.float64):
+    """Convert masked ADC codes of 'sample_w' bits to volts ('v_ref' full scale)"""
+    sample_n = 2 ** sample_w
+    lut = (v_ref / sample_n) * (np.arange(sample_n) - sample_n // 2)
+    return np.take(lut.astype(dtype, copy=False), np.bitwise_and(codes, sample_n - 1))
+
+
+class Capture(Mapping):
+    """Read-only dictionnary view over a saved acquisition.
+
+    Captures saved with raw=True hold ADC codes in "raw": "signal" is then
+    converted to volts on first access only. Older captures, with voltages
+    already in "signal", are returned as is.
+    """
+
+    def __init__(self, data):
+        self._data = data
+        self._signal = None
+
+    def __getitem__(self, key):
+        if key == "signal" and "signal" not in self._data:
+            if self._signal is None:
+                self._signal = codes_to_voltage(self._data["raw"], int(self._data["sample_w"]),
+                                                float(self._data["v_ref"]))
+            return self._signal
+        return self._data[key]
+
+    def __iter__(self):
+        keys = list(self._data)
+        if "signal" not in keys:
+            keys += ["signal"]
+        return iter(keys)
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    @property
+    def is_raw(self):
+        """True if the capture holds ADC codes"""
+        return "raw" in self._data
+
+
+def load_capture(npz_path):
+    """Load a .npz capture, in raw or voltage format"""
+    with np.load(npz_path) as npz:
+        data = {key: npz[key] for key in npz.files}
+    return Capture(data)
@@ -9,9 +9,13 @@
     __version__ = "0.1"
 """
 import argparse
+import time
+import numpy as np
 from . import fpga_ctrl as USB
 from . import cvplotter
 from . import signal_utils as sigutils
+from .acq_pipeline import AcquisitionPipeline
+from .stream_server import StreamServer
 
 def init_un0rick(device='ftdi://ftdi:2232:/'):
     """ un0rick board initialisation """
@@ -20,7 +24,48 @@ def init_un0rick(device='ftdi://ftdi:2232:/'):
     fpga.reset()
     return fpga
 
-def continuous_acq(acq_lines=32, double_rate=True):
+class Hud():
+    """ Frame rate, latency and per stage durations, smoothed for display """
+
+    def __init__(self, smoothing=0.1):
+        self.smoothing = smoothing
+        self.values = {}
+        self._last_frame = None
+
+    def update(self, name, seconds):
+        """ Account a new duration of 'name', in seconds """
+        old = self.values.get(name)
+        self.values[name] = seconds if old is None else old + self.smoothing * (seconds - old)
+
+    def frame(self):
+        """ Account a new displayed frame """
+        now = time.perf_counter()
+        if self._last_frame is not None:
+            self.update("period", now - self._last_frame)
+        self._last_frame = now
+
+    def texts(self, stages=(), extra=""):
+        """ Text lines to display """
+        period = self.values.get("period")
+        res = ["%.1f fps" % (1 / period if period else 0),
+               "latency %.1f ms" % (1E3 * self.values.get("latency", 0))]
+        stages_ms = ["%s %.1f ms" % (name, 1E3 * self.values[name])
+                     for name in stages if name in self.values]
+        if stages_ms:
+            res += [" | ".join(stages_ms)]
+        if extra:
+            res += [extra]
+        return res
+
+def make_plotter(waterfall=False):
+    """ Display of the processed signals: A-scan trace or B-scan waterfall """
+    if waterfall:
+        return cvplotter.WaterfallPlotter((800, 500), (-1, 1), db_range=40)
+    return cvplotter.Plotter((800, 500), (0, 256), (-1, 1))
+
+def continuous_acq(acq_lines=32, double_rate=True, pipelined=False,
+                   queue_size=4, policy="drop_oldest", waterfall=False,
+                   serve=None, decimation=1):
     """
     Perform a continuous acquisition, and display it
     in a opencv container.
@@ -33,15 +78,77 @@ def continuous_acq(acq_lines=32, double_rate=True):
     double_rate: Boolean
         Perform acquisitions à double rates to be able to interleave the
         measurements.
+
+    pipelined: Boolean
+        Acquire in a dedicated thread while previous frames are processed
+        (see acq_pipeline.AcquisitionPipeline).
+
+    queue_size: Integer
+        Pipelined mode: number of frames buffered between stages.
+
+    policy: str
+        Pipelined mode: "drop_oldest" or "block" when a stage is late.
+
+    waterfall: Boolean
+        Display consecutive acquisitions as a scrolling B-scan instead of
+        the last A-scan trace.
+
+    serve: str or tuple
+        Also stream the raw acquisitions to local clients on this
+        'host:port' or Unix socket path (see stream_server.StreamServer).
+        Not available in pipelined mode.
+
+    decimation: Integer
+        Default decimation factor of the streamed acquisitions.
     """
+    if pipelined and serve is not None:
+        raise ValueError("Streaming is only available without pipelining")
     fpga = init_un0rick()
-    while 1:
-        fpga.do_acquisition(acq_lines=acq_lines, double_rate=double_rate)
-        # Make a copy of the signal to avoid problems with modifications
-        # as it should impact un0usb.fpga
-        data = fpga.get_data().copy()
-        res = sigutils.process_data(data, interleaved=double_rate)
-        cvplotter.Plotter((800, 500), (0, 256), (-1, 1)).plot(res)
+    plotter = make_plotter(waterfall)
+    hud = Hud()
+    if pipelined:
+        with AcquisitionPipeline(fpga, acq_lines=acq_lines, double_rate=double_rate,
+                                 queue_size=queue_size, policy=policy) as pipeline:
+            for frame in pipeline:
+                start = time.perf_counter()
+                stats = pipeline.stats()
+                plotter.plot(frame.result, hud=hud.texts(
+                    ("display",), "dropped %d" % (stats["dropped_raw"] + stats["dropped_out"])))
+                hud.update("display", time.perf_counter() - start)
+                hud.update("latency", time.time() - frame.timestamp)
+                hud.frame()
+        return
+    # Lines, voltage and result buffers and time axis reused for every frame
+    lines_buf = fpga.alloc_lines(acq_lines)
+    volt_buf = np.empty(lines_buf.shape, dtype=np.float32)
+    res_buf = np.empty((fpga.WORDS_PER_LINE * (2 if double_rate else 1), 2), dtype=np.float32)
+    t_axis = sigutils.time_axis(fpga.WORDS_PER_LINE, False, fpga.SAMPLE_CLOCK)
+    server = None if serve is None else StreamServer(serve, decimation=decimation)
+    try:
+        while 1:
+            start = time.perf_counter()
+            # The lines returned by the acquisition are processed directly:
+            # no second SRAM readout through get_data()
+            lines = fpga.do_acquisition(acq_lines=acq_lines, double_rate=double_rate,
+                                        out=lines_buf)
+            acquired = time.perf_counter()
+            if server is not None:
+                server.publish_acquisition(fpga, lines)
+            data = {"signal": fpga.lines_to_voltage(lines, np.float32, volt_buf[:len(lines)]),
+                    "t": t_axis}
+            res = sigutils.process_data(data, interleaved=double_rate, out=res_buf)
+            processed = time.perf_counter()
+            plotter.plot(res, hud=hud.texts(("acq", "proc", "display")))
+            displayed = time.perf_counter()
+            hud.update("acq", acquired - start)
+            hud.update("proc", processed - acquired)
+            hud.update("display", displayed - processed)
+            hud.update("latency", displayed - start)
+            hud.frame()
+    finally:
+        # listening socket, client threads and Unix socket file
+        if server is not None:
+            server.close()
 
 if __name__ == "__main__":
     PARSER = argparse.ArgumentParser(description="Start a continuous "
@@ -57,5 +164,36 @@ if __name__ == "__main__":
                         default=False,
                         action="store_true")
 
+    PARSER.add_argument("-p", "--pipelined",
+                        help="Acquire in a separate thread while processing "
+                             "and displaying previous frames.",
+                        default=False,
+                        action="store_true")
+
+    PARSER.add_argument("-b", "--block",
+                        help="Pipelined mode: wait for the display instead "
+                             "of dropping the oldest frames.",
+                        default=False,
+                        action="store_true")
+
+    PARSER.add_argument("-w", "--waterfall",
+                        help="Display a scrolling B-scan of the acquisitions.",
+                        default=False,
+                        action="store_true")
+
+    PARSER.add_argument("-s", "--serve",
+                        help="Also stream the acquisitions to local clients "
+                             "on this host:port or Unix socket path.",
+                        default=None)
+
+    PARSER.add_argument("-x", "--decimation",
+                        type=int,
+                        help="Default decimation factor of the streamed "
+                             "acquisitions.",
+                        default=1)
+
     ARGS = PARSER.parse_args()
-    continuous_acq(ARGS.acqlines, ARGS.doublerate)
+    continuous_acq(ARGS.acqlines, ARGS.doublerate, pipelined=ARGS.pipelined,
+                   policy="block" if ARGS.block else "drop_oldest",
+                   waterfall=ARGS.waterfall, serve=ARGS.serve,
+                   decimation=ARGS.decimation)
@@ -1,3 +1,6 @@
+from contextlib import contextmanager
+
+import numpy as np
 
 
 class CsrMap:
@@ -155,92 +158,182 @@ class CsrMap:
     VERSION_WIDTH = 8
     VERSION_MASK = 0xff
 
-    def __init__(self, ftdidev):
+    # Registers changed by the FPGA itself, and write-only strobes -- never
+    # served from (nor written to) the shadow cache
+    VOLATILE_ADDRS = frozenset([ACQDONE_ADDR, ACQBUSY_ADDR,
+                                TOPTURN1_ADDR, TOPTURN2_ADDR, TOPTURN3_ADDR,
+                                JUMPER1_ADDR, JUMPER2_ADDR, JUMPER3_ADDR,
+                                RAMDATA_ADDR, RAMFDONE_ADDR,
+                                ACQSTART_ADDR, RAMRADDRRST_ADDR,
+                                RAMFINC_ADDR, RAMFDEC_ADDR])
+
+    def __init__(self, ftdidev, shadow=True):
+        """Keyword arguments:
+         ftdidev -- FtdiDevice instance
+         shadow -- keep a write-through copy of configuration registers, so
+                   reading them back does not go through the SPI bus
+        """
         self._ftdi = ftdidev
+        self.shadow = shadow
+        self._shadow_regs = {}
+        self._batch = None
+
+    def invalidate(self):
+        """Drop all shadowed register values (after FPGA reset or reload)"""
+        self._shadow_regs.clear()
+
+    @contextmanager
+    def batch(self):
+        """Context to send all register writes done inside it in one USB transfer.
+
+        Yields the FtdiDevice SpiBatch, so extra reads can be queued with
+        batch.read(addr, len, burst) and collected in batch.results on exit.
+        Reading a register property inside the context flushes the queue first.
+        Nested contexts join the outermost batch.
+        """
+        if self._batch is not None:
+            yield self._batch
+            return
+        self._batch = self._ftdi.batch()
+        try:
+            yield self._batch
+            self._batch.flush()
+        except BaseException:
+            # queued writes were never sent
+            self.invalidate()
+            raise
+        finally:
+            self._batch = None
+
+    def _addrs(self, addr, len, burst):
+        """List of register addresses touched by a transaction"""
+        if burst == 'incr':
+            return list(range(addr, addr + len))
+        return [addr] * len
+
+    def _read(self, addr, len=1, burst='fixed'):
+        """Read registers, serving configuration registers from the shadow cache"""
+        if not self.shadow or addr in self.VOLATILE_ADDRS:
+            return self._spi_read(addr, len, burst)
+        addrs = self._addrs(addr, len, burst)
+        try:
+            return [self._shadow_regs[a] for a in addrs]
+        except KeyError:
+            data = self._spi_read(addr, len, burst)
+            self._shadow_regs.update(zip(addrs, data))
+            return data
+
+    def shadowed(self, addr, len=1, burst='fixed'):
+        """Return the cached values of registers, None if any is not in the shadow cache"""
+        if not self.shadow or addr in self.VOLATILE_ADDRS:
+            return None
+        try:
+            return [self._shadow_regs[a] for a in self._addrs(addr, len, burst)]
+        except KeyError:
+            return None
+
+    def _spi_read(self, addr, len, burst):
+        """Read registers from the bus, after sending pending batched writes"""
+        if self._batch is not None:
+            self._batch.flush()
+        return self._ftdi.spi_read(addr, len=len, burst=burst)
+
+    def _write(self, addr, data, burst='fixed'):
+        """Write registers and update the shadow cache"""
+        if self._batch is not None:
+            self._batch.write(addr, data, burst=burst)
+        else:
+            self._ftdi.spi_write(addr, data, burst=burst)
+        if self.shadow and addr not in self.VOLATILE_ADDRS:
+            self._shadow_regs.update(zip(self._addrs(addr, len(data), burst), data))
 
     @property
     def initdel(self):
         """Get current INITDEL register value"""
-        data = self._ftdi.spi_read(self.INITDEL_ADDR, len=1, burst='fixed')
+        data = self._read(self.INITDEL_ADDR, len=1, burst='fixed')
         return data[0] & self.INITDEL_MASK
 
     @initdel.setter
     def initdel(self, val):
         """Set INITDEL register with new value"""
         data = val & self.INITDEL_MASK
-        self._ftdi.spi_write(self.INITDEL_ADDR, [data], burst='fixed')
+        self._write(self.INITDEL_ADDR, [data], burst='fixed')
 
     @property
     def ponw(self):
         """Get current PONW register value"""
-        data = self._ftdi.spi_read(self.PONW_ADDR, len=1, burst='fixed')
+        data = self._read(self.PONW_ADDR, len=1, burst='fixed')
         return data[0] & self.PONW_MASK
 
     @ponw.setter
     def ponw(self, val):
         """Set PONW register with new value"""
         data = val & self.PONW_MASK
-        self._ftdi.spi_write(self.PONW_ADDR, [data], burst='fixed')
+        self._write(self.PONW_ADDR, [data], burst='fixed')
 
     @property
     def poffw(self):
         """Get current POFFW register value"""
-        data = self._ftdi.spi_read(self.POFFW_ADDR, len=1, burst='fixed')
+        data = self._read(self.POFFW_ADDR, len=1, burst='fixed')
         return data[0] & self.POFFW_MASK
 
     @poffw.setter
     def poffw(self, val):
         """Set POFFW register with new value"""
         data = val & self.POFFW_MASK
-        self._ftdi.spi_write(self.POFFW_ADDR, [data], burst='fixed')
+        self._write(self.POFFW_ADDR, [data], burst='fixed')
 
     @property
     def interw(self):
         """Get current INTERW register value"""
-        data = self._ftdi.spi_read(self.INTERW_ADDR, len=1, burst='fixed')
+        data = self._read(self.INTERW_ADDR, len=1, burst='fixed')
         return data[0] & self.INTERW_MASK
 
     @interw.setter
     def interw(self, val):
         """Set INTERW register with new value"""
         data = val & self.INTERW_MASK
-        self._ftdi.spi_write(self.INTERW_ADDR, [data], burst='fixed')
+        self._write(self.INTERW_ADDR, [data], burst='fixed')
 
     @property
     def drmode(self):
         """Get current DRMODE register value"""
-        data = self._ftdi.spi_read(self.DRMODE_ADDR, len=1, burst='fixed')
+        data = self._read(self.DRMODE_ADDR, len=1, burst='fixed')
         return data[0] & self.DRMODE_MASK
 
     @drmode.setter
     def drmode(self, val):
         """Set DRMODE register with new value"""
         data = val & self.DRMODE_MASK
-        self._ftdi.spi_write(self.DRMODE_ADDR, [data], burst='fixed')
+        self._write(self.DRMODE_ADDR, [data], burst='fixed')
 
     @property
     def dacout(self):
         """Get current DACOUT register value"""
-        data = self._ftdi.spi_read(self.DACOUT_ADDR, len=1, burst='fixed')
+        data = self._read(self.DACOUT_ADDR, len=1, burst='fixed')
         return data[0] & self.DACOUT_MASK
 
     @dacout.setter
     def dacout(self, val):
         """Set DACOUT register with new value"""
         data = val & self.DACOUT_MASK
-        self._ftdi.spi_write(self.DACOUT_ADDR, [data], burst='fixed')
+        self._write(self.DACOUT_ADDR, [data], burst='fixed')
 
     @property
     def dacgain(self):
         """Get current DACGAIN registers values"""
-        data = self._ftdi.spi_read(self.DACGAIN_ADDR, len=self.DACGAIN_N, burst='incr')
+        data = self._read(self.DACGAIN_ADDR, len=self.DACGAIN_N, burst='incr')
         return [w & self.DACGAIN_MASK for w in data]
 
     @dacgain.setter
     def dacgain(self, val):
         """Set DACGAIN registers with new values"""
-        data = [w & self.DACGAIN_MASK for w in val]
-        self._ftdi.spi_write(self.DACGAIN_ADDR, data, burst='incr')
+        self.write_dacgain(val)
+
+    def write_dacgain(self, val, start=0):
+        """Set DACGAIN registers from index 'start' with new values"""
+        data = [int(w) & self.DACGAIN_MASK for w in val]
+        self._write(self.DACGAIN_ADDR + start, data, burst='incr')
 
     @property
     def acqstart(self):
@@ -251,145 +344,151 @@ class CsrMap:
     def acqstart(self, val):
         """Set ACQSTART register with new value"""
         data = val & self.ACQSTART_MASK
-        self._ftdi.spi_write(self.ACQSTART_ADDR, [data], burst='fixed')
+        self._write(self.ACQSTART_ADDR, [data], burst='fixed')
 
     @property
     def acqdone(self):
         """Get current ACQDONE register value"""
-        data = self._ftdi.spi_read(self.ACQDONE_ADDR, len=1, burst='fixed')
+        data = self._read(self.ACQDONE_ADDR, len=1, burst='fixed')
         return data[0] & self.ACQDONE_MASK
 
     @property
     def nblines(self):
         """Get current NBLINES register value"""
-        data = self._ftdi.spi_read(self.NBLINES_ADDR, len=1, burst='fixed')
+        data = self._read(self.NBLINES_ADDR, len=1, burst='fixed')
         return data[0] & self.NBLINES_MASK
 
     @nblines.setter
     def nblines(self, val):
         """Set NBLINES register with new value"""
         data = val & self.NBLINES_MASK
-        self._ftdi.spi_write(self.NBLINES_ADDR, [data], burst='fixed')
+        self._write(self.NBLINES_ADDR, [data], burst='fixed')
 
     @property
     def acqbusy(self):
         """Get current ACQBUSY register value"""
-        data = self._ftdi.spi_read(self.ACQBUSY_ADDR, len=1, burst='fixed')
+        data = self._read(self.ACQBUSY_ADDR, len=1, burst='fixed')
         return data[0] & self.ACQBUSY_MASK
 
     @property
     def led1(self):
         """Get current LED1 register value"""
-        data = self._ftdi.spi_read(self.LED1_ADDR, len=1, burst='fixed')
+        data = self._read(self.LED1_ADDR, len=1, burst='fixed')
         return data[0] & self.LED1_MASK
 
     @led1.setter
     def led1(self, val):
         """Set LED1 register with new value"""
         data = val & self.LED1_MASK
-        self._ftdi.spi_write(self.LED1_ADDR, [data], burst='fixed')
+        self._write(self.LED1_ADDR, [data], burst='fixed')
 
     @property
     def led2(self):
         """Get current LED2 register value"""
-        data = self._ftdi.spi_read(self.LED2_ADDR, len=1, burst='fixed')
+        data = self._read(self.LED2_ADDR, len=1, burst='fixed')
         return data[0] & self.LED2_MASK
 
     @led2.setter
     def led2(self, val):
         """Set LED2 register with new value"""
         data = val & self.LED2_MASK
-        self._ftdi.spi_write(self.LED2_ADDR, [data], burst='fixed')
+        self._write(self.LED2_ADDR, [data], burst='fixed')
 
     @property
     def led3(self):
         """Get current LED3 register value"""
-        data = self._ftdi.spi_read(self.LED3_ADDR, len=1, burst='fixed')
+        data = self._read(self.LED3_ADDR, len=1, burst='fixed')
         return data[0] & self.LED3_MASK
 
     @led3.setter
     def led3(self, val):
         """Set LED3 register with new value"""
         data = val & self.LED3_MASK
-        self._ftdi.spi_write(self.LED3_ADDR, [data], burst='fixed')
+        self._write(self.LED3_ADDR, [data], burst='fixed')
 
     @property
     def topturn1(self):
         """Get current TOPTURN1 register value"""
-        data = self._ftdi.spi_read(self.TOPTURN1_ADDR, len=1, burst='fixed')
+        data = self._read(self.TOPTURN1_ADDR, len=1, burst='fixed')
         return data[0] & self.TOPTURN1_MASK
 
     @property
     def topturn2(self):
         """Get current TOPTURN2 register value"""
-        data = self._ftdi.spi_read(self.TOPTURN2_ADDR, len=1, burst='fixed')
+        data = self._read(self.TOPTURN2_ADDR, len=1, burst='fixed')
         return data[0] & self.TOPTURN2_MASK
 
     @property
     def topturn3(self):
         """Get current TOPTURN3 register value"""
-        data = self._ftdi.spi_read(self.TOPTURN3_ADDR, len=1, burst='fixed')
+        data = self._read(self.TOPTURN3_ADDR, len=1, burst='fixed')
         return data[0] & self.TOPTURN3_MASK
 
     @property
     def jumper1(self):
         """Get current JUMPER1 register value"""
-        data = self._ftdi.spi_read(self.JUMPER1_ADDR, len=1, burst='fixed')
+        data = self._read(self.JUMPER1_ADDR, len=1, burst='fixed')
         return data[0] & self.JUMPER1_MASK
 
     @property
     def jumper2(self):
         """Get current JUMPER2 register value"""
-        data = self._ftdi.spi_read(self.JUMPER2_ADDR, len=1, burst='fixed')
+        data = self._read(self.JUMPER2_ADDR, len=1, burst='fixed')
         return data[0] & self.JUMPER2_MASK
 
     @property
     def jumper3(self):
         """Get current JUMPER3 register value"""
-        data = self._ftdi.spi_read(self.JUMPER3_ADDR, len=1, burst='fixed')
+        data = self._read(self.JUMPER3_ADDR, len=1, burst='fixed')
         return data[0] & self.JUMPER3_MASK
 
     @property
     def out1ice(self):
         """Get current OUT1ICE register value"""
-        data = self._ftdi.spi_read(self.OUT1ICE_ADDR, len=1, burst='fixed')
+        data = self._read(self.OUT1ICE_ADDR, len=1, burst='fixed')
         return data[0] & self.OUT1ICE_MASK
 
     @out1ice.setter
     def out1ice(self, val):
         """Set OUT1ICE register with new value"""
         data = val & self.OUT1ICE_MASK
-        self._ftdi.spi_write(self.OUT1ICE_ADDR, [data], burst='fixed')
+        self._write(self.OUT1ICE_ADDR, [data], burst='fixed')
 
     @property
     def out2ice(self):
         """Get current OUT2ICE register value"""
-        data = self._ftdi.spi_read(self.OUT2ICE_ADDR, len=1, burst='fixed')
+        data = self._read(self.OUT2ICE_ADDR, len=1, burst='fixed')
         return data[0] & self.OUT2ICE_MASK
 
     @out2ice.setter
     def out2ice(self, val):
         """Set OUT2ICE register with new value"""
         data = val & self.OUT2ICE_MASK
-        self._ftdi.spi_write(self.OUT2ICE_ADDR, [data], burst='fixed')
+        self._write(self.OUT2ICE_ADDR, [data], burst='fixed')
 
     @property
     def out3ice(self):
         """Get current OUT3ICE register value"""
-        data = self._ftdi.spi_read(self.OUT3ICE_ADDR, len=1, burst='fixed')
+        data = self._read(self.OUT3ICE_ADDR, len=1, burst='fixed')
         return data[0] & self.OUT3ICE_MASK
 
     @out3ice.setter
     def out3ice(self, val):
         """Set OUT3ICE register with new value"""
         data = val & self.OUT3ICE_MASK
-        self._ftdi.spi_write(self.OUT3ICE_ADDR, [data], burst='fixed')
+        self._write(self.OUT3ICE_ADDR, [data], burst='fixed')
 
     @property
     def ramdata(self):
-        """Get all data from RAMDATA buffer"""
-        data = self._ftdi.spi_read(self.RAMDATA_ADDR, len=self.RAMDATA_N, burst='fixed')
-        return [w & self.RAMDATA_MASK for w in data]
+        """Get all data from RAMDATA buffer as numpy uint16 array"""
+        if self._batch is not None:
+            self._batch.flush()
+        data = self._ftdi.spi_read_array(self.RAMDATA_ADDR, len=self.RAMDATA_N, burst='fixed')
+        return self.decode_ramdata(data)
+
+    def decode_ramdata(self, data):
+        """Convert big-endian words read from RAMDATA to a native uint16 array"""
+        return np.bitwise_and(data, self.RAMDATA_MASK, dtype=np.uint16)
 
     @property
     def ramraddrrst(self):
@@ -400,7 +499,7 @@ class CsrMap:
     def ramraddrrst(self, val):
         """Set RAMRADDRRST register with new value"""
         data = val & self.RAMRADDRRST_MASK
-        self._ftdi.spi_write(self.RAMRADDRRST_ADDR, [data], burst='fixed')
+        self._write(self.RAMRADDRRST_ADDR, [data], burst='fixed')
 
     @property
     def ramfinc(self):
@@ -411,7 +510,7 @@ class CsrMap:
     def ramfinc(self, val):
         """Set RAMFINC register with new value"""
         data = val & self.RAMFINC_MASK
-        self._ftdi.spi_write(self.RAMFINC_ADDR, [data], burst='fixed')
+        self._write(self.RAMFINC_ADDR, [data], burst='fixed')
 
     @property
     def ramfdec(self):
@@ -422,22 +521,22 @@ class CsrMap:
     def ramfdec(self, val):
         """Set RAMFDEC register with new value"""
         data = val & self.RAMFDEC_MASK
-        self._ftdi.spi_write(self.RAMFDEC_ADDR, [data], burst='fixed')
+        self._write(self.RAMFDEC_ADDR, [data], burst='fixed')
 
     @property
     def ramfdone(self):
         """Get current RAMFDONE register value"""
-        data = self._ftdi.spi_read(self.RAMFDONE_ADDR, len=1, burst='fixed')
+        data = self._read(self.RAMFDONE_ADDR, len=1, burst='fixed')
         return data[0] & self.RAMFDONE_MASK
 
     @property
     def author(self):
         """Get current AUTHOR register value"""
-        data = self._ftdi.spi_read(self.AUTHOR_ADDR, len=1, burst='fixed')
+        data = self._read(self.AUTHOR_ADDR, len=1, burst='fixed')
         return data[0] & self.AUTHOR_MASK
 
     @property
     def version(self):
         """Get current VERSION register value"""
-        data = self._ftdi.spi_read(self.VERSION_ADDR, len=1, burst='fixed')
+        data = self._read(self.VERSION_ADDR, len=1, burst='fixed')
         return data[0] & self.VERSION_MASK
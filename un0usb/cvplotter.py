@@ -14,13 +14,28 @@
 import cv2
 import numpy as np
 
+def draw_hud(img, texts, color=(255, 255, 255)):
+    """
+    Overlay text lines on the top left corner of an image (in place).
+
+    Return
+    -------
+    numpy array
+        img
+    """
+    for i, text in enumerate(texts):
+        cv2.putText(img, text, (8, 18 + 18 * i), cv2.FONT_HERSHEY_SIMPLEX,
+                    0.45, color, 1, cv2.LINE_AA)
+    return img
+
 class Plotter():
     """ A class used to display a signal on screen using opencv """
     canvas = None
     line_color_rvb = (0, 255, 0)
     name = None
 
-    def __init__(self, size, xrange, yrange, name="OpenCV Plotter"):
+    def __init__(self, size, xrange, yrange, name="OpenCV Plotter",
+                 decimate=True):
         """
         Parameters
         ----------
@@ -38,6 +53,10 @@ class Plotter():
 
         name : str
             Name of the OpenCV window
+
+        decimate : Boolean
+            Draw signals with more points than pixels as a per pixel column
+            min/max envelope: peaks stay visible with much less vertices.
         """
         self.width, self.height = size
         xmin, xmax = xrange
@@ -46,6 +65,11 @@ class Plotter():
         self.yfactor = self.height / (abs(ymax)+abs(ymin))
         self.xaxis_position = ymax * self.yfactor
         self.name = name
+        self.decimate = decimate
+        # canvas reused for every frame
+        self.canvas = np.ones((self.height, self.width, 3), np.uint8)
+        # pixel columns of the last x axis: (key, column starts, column x)
+        self._columns = (None, None, None)
 
     def to_opencv_references(self, xy_arr):
         """
@@ -68,7 +92,69 @@ class Plotter():
 
         return _xy_arr
 
-    def plot(self, xy_arr, wait_ms=10):
+    def render(self, xy_arr):
+        """
+        Draw a numpy array in an image, without displaying it.
+
+        Parameters
+        ----------
+        xy_arr : list
+            [x, y] data to display. Ex: [[x1, y1], [x2, y2] ...]
+
+        Return
+        -------
+        numpy array
+            (height, width, 3) image
+        """
+        self.canvas.fill(1)
+        if self.decimate and len(xy_arr) > 2 * self.width:
+            signal = self.envelope(xy_arr)
+        else:
+            signal = self.to_opencv_references(xy_arr).astype(np.int32)
+        return cv2.polylines(self.canvas, [signal], False,
+                             self.line_color_rvb, thickness=1)
+
+    def pixel_columns(self, x_arr):
+        """
+        Split a sorted x axis in pixel columns. Cached for a fixed x axis.
+
+        Return
+        -------
+        tuple
+            (index of the first point of every column, column x in pixels)
+        """
+        key = (len(x_arr), float(x_arr[0]), float(x_arr[-1]))
+        if self._columns[0] != key:
+            pixels = np.floor(np.asarray(x_arr) * self.xfactor).astype(np.int32)
+            starts = np.flatnonzero(np.diff(pixels)) + 1
+            starts = np.concatenate(([0], starts))
+            self._columns = (key, starts, pixels[starts])
+        return self._columns[1:]
+
+    def envelope(self, xy_arr):
+        """
+        Reduce a signal to its min/max per pixel column, in OpenCV references.
+
+        Parameter
+        ----------
+        xy_arr : list
+            [x, y] data to display, x sorted. Ex: [[x1, y1], [x2, y2] ...]
+
+        Return
+        -------
+        numpy array
+            int32 vertices: (column, max), (column, min) for every column
+        """
+        starts, columns = self.pixel_columns(xy_arr[:, 0])
+        y_arr = xy_arr[:, 1]
+        vertices = np.empty((2 * len(starts), 2), np.int32)
+        vertices[0::2, 0] = columns
+        vertices[1::2, 0] = columns
+        vertices[0::2, 1] = self.xaxis_position - np.maximum.reduceat(y_arr, starts) * self.yfactor
+        vertices[1::2, 1] = self.xaxis_position - np.minimum.reduceat(y_arr, starts) * self.yfactor
+        return vertices
+
+    def plot(self, xy_arr, wait_ms=10, hud=None):
         """
         Plot a numpy array using openCV.
 
@@ -76,11 +162,138 @@ class Plotter():
         ----------
         xy_arr : list
             [x, y] data to display. Ex: [[x1, y1], [x2, y2] ...]
+
+        hud : list
+            Text lines to overlay on the top left corner.
+        """
+        img = self.render(xy_arr)
+        if hud:
+            draw_hud(img, hud)
+        cv2.imshow(self.name, img)
+        cv2.waitKey(wait_ms)
+
+
+class WaterfallPlotter():
+    """
+    A class used to display consecutive signals as a scrolling B-scan:
+    every new signal is one image column (depth from top to bottom),
+    the oldest column scrolls out on the left.
+    """
+    name = None
+
+    def __init__(self, size, yrange=(-1, 1), name="OpenCV B-scan",
+                 colormap=cv2.COLORMAP_JET, db_range=None):
+        """
+        Parameters
+        ----------
+        size : tuple
+            Shall contains (width, heigh) of the openCV window:
+            width is the number of signals kept in history,
+            height the number of depth pixels.
+
+        yrange : tuple
+            Shall contains (ymin, ymax) of the signal. The envelope is
+            displayed from 0 to max(abs(ymin), abs(ymax)).
+
+        name : str
+            Name of the OpenCV window
+
+        colormap : int or numpy array
+            OpenCV colormap id (cv2.COLORMAP_*), or (256, 3) uint8 BGR
+            lookup table.
+
+        db_range : float
+            If set, display the envelope in dB, from -db_range to 0 dB.
+        """
+        self.width, self.height = size
+        ymin, ymax = yrange
+        self.vmax = max(abs(ymin), abs(ymax))
+        self.db_range = db_range
+        self.name = name
+        self.set_colormap(colormap)
+        # every column is written twice, at 'pos' and 'pos + width', so that
+        # the last 'width' columns are always a contiguous slice: no copy
+        self._ring = np.zeros((self.height, 2 * self.width, 3), np.uint8)
+        self._pos = 0
+        # depth bins of the last signal length: (length, bin starts)
+        self._bins = (None, None)
+
+    def set_colormap(self, colormap):
+        """Set the colormap: OpenCV colormap id or (256, 3) uint8 BGR table"""
+        if np.isscalar(colormap):
+            colormap = cv2.applyColorMap(np.arange(256, dtype=np.uint8), colormap)
+        self.lut = np.ascontiguousarray(np.asarray(colormap, np.uint8).reshape(256, 3))
+
+    def depth_bins(self, length):
+        """First sample index of every depth pixel for a 'length' signal (cached)"""
+        if self._bins[0] != length:
+            starts = (np.arange(self.height) * length) // self.height
+            self._bins = (length, starts)
+        return self._bins[1]
+
+    def column(self, y_arr):
+        """
+        Envelope of a signal decimated to the display height, as intensities.
+
+        Return
+        -------
+        numpy array
+            (height,) uint8 intensities
+        """
+        env = np.maximum.reduceat(np.abs(y_arr), self.depth_bins(len(y_arr)))
+        if self.db_range:
+            env = 20 * np.log10(np.maximum(env / self.vmax, 1e-12))
+            env = (env + self.db_range) / self.db_range
+        else:
+            env = env / self.vmax
+        return (np.clip(env, 0, 1) * 255).astype(np.uint8)
+
+    def add(self, xy_arr):
+        """
+        Add one signal to the history.
+
+        Parameters
+        ----------
+        xy_arr : list
+            [x, y] data (signal_utils.process_data result), or y data only.
+        """
+        xy_arr = np.asarray(xy_arr)
+        y_arr = xy_arr[:, 1] if xy_arr.ndim == 2 else xy_arr
+        colors = self.lut[self.column(y_arr)]
+        self._ring[:, self._pos] = colors
+        self._ring[:, self._pos + self.width] = colors
+        self._pos = (self._pos + 1) % self.width
+
+    def render(self, xy_arr=None):
+        """
+        Add a signal (if given) and return the image of the history.
+
+        Return
+        -------
+        numpy array
+            (height, width, 3) BGR image, oldest signal on the left.
+            A view of the history ring: it changes with next signals.
+        """
+        if xy_arr is not None:
+            self.add(xy_arr)
+        return self._ring[:, self._pos:self._pos + self.width]
+
+    def plot(self, xy_arr, wait_ms=10, hud=None):
+        """
+        Add a signal and display the history using openCV.
+
+        Parameters
+        ----------
+        xy_arr : list
+            [x, y] data to display. Ex: [[x1, y1], [x2, y2] ...]
+
+        hud : list
+            Text lines to overlay on the top left corner.
         """
-        self.canvas = np.ones((self.height, self.width, 3), np.int8)
-        signal = self.to_opencv_references(xy_arr).astype(np.int32)
-        img = cv2.polylines(self.canvas, [signal], False,
-                            self.line_color_rvb, thickness=1)
+        img = self.render(xy_arr)
+        if hud:
+            # do not write the text in the history
+            img = draw_hud(img.copy(), hud)
         cv2.imshow(self.name, img)
         cv2.waitKey(wait_ms)
 
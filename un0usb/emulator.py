@@ -0,0 +1,228 @@
+'''
+Hardware-free emulation of the un0rick board behind the FtdiDevice API
+'''
+
+import time
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+from un0usb.csr_map import CsrMap
+from un0usb.ftdi_dev import FtdiDevice
+from un0usb.signal_utils import acq_time, SAMPLE_CLOCK
+
+EMU_SCHEME = 'emu'
+
+
+def is_emulator_url(url):
+    """True if 'url' selects the emulator (emu://...)"""
+    return url.startswith(EMU_SCHEME + '://')
+
+
+class EmuDevice(FtdiDevice):
+    """Drop-in replacement of FtdiDevice emulating the FPGA side of the SPI link.
+
+    The SPI transactions (control word + data words, see FtdiDevice) are
+    decoded and applied to an emulated register file and to the 32x16384
+    words external RAM:
+      - ACQSTART fills NBLINES+1 RAM lines with synthetic echoes (shaped by
+        DACGAIN, half sample shifted on odd lines in DRMODE) and ACQDONE is
+        raised after the acquisition duration;
+      - RAMDATA reads auto-increment the RAM read address, RAMRADDRRST resets it;
+      - RAMFINC/RAMFDEC fill the RAM with incrementing/decrementing patterns.
+
+    Device url options, e.g. 'emu://?latency=0.001&bandwidth=1e6&realtime=0':
+      - latency -- seconds per USB transfer (default 0);
+      - bandwidth -- SPI bytes per second (default spi_freq / 8, 0 - infinite);
+      - realtime -- 1 to delay ACQDONE by the acquisition duration (default 1);
+      - seed -- random seed of the emulated noise.
+    """
+
+    AUTHOR = 0x01
+    VERSION = 0x02
+    RAM_LINES = 32
+    # echoes of the synthetic target: (time in us, amplitude in ADC codes)
+    ECHOES = ((22.0, 120.0), (64.0, 60.0), (130.0, 30.0))
+    ECHO_FREQ = 4.0  # MHz
+    NOISE_CODES = 2.0
+
+    def __init__(self, ftdi_url='emu://', spi_freq=1E6):
+        """Configure the emulator.
+
+        Keyword arguments:
+         ftdi_url -- 'emu://' url with optional query options
+         spi_freq -- SPI frequency, used for the default bandwidth
+        """
+        options = {k: v[-1] for k, v in parse_qs(urlparse(ftdi_url).query).items()}
+        self.latency = float(options.get('latency', 0))
+        self.bandwidth = float(options.get('bandwidth', spi_freq / 8))
+        self.realtime = bool(int(options.get('realtime', 1)))
+        self._rng = np.random.default_rng(int(options['seed']) if 'seed' in options else None)
+        self._spi_port = self
+        self.transfers = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self._noise = np.rint(self._rng.normal(0, self.NOISE_CODES, (64, CsrMap.RAMDATA_N))).astype(np.int16)
+        self._templates = {}
+        self.reload_config()
+
+    def reload_config(self):
+        """Emulate the FPGA configuration load (registers and RAM defaults)"""
+        self._ram = np.zeros((self.RAM_LINES, CsrMap.RAMDATA_N), dtype=np.uint16)
+        self._gain = [512] * CsrMap.DACGAIN_N
+        self.reset_logic()
+
+    def reset_logic(self):
+        """Emulate the FPGA logic reset"""
+        self._regs = {}
+        self._regs[CsrMap.AUTHOR_ADDR] = self.AUTHOR
+        self._regs[CsrMap.VERSION_ADDR] = self.VERSION
+        self._raddr = 0
+        self._done_at = None
+        self._ramfdone = 0
+
+    def _transfer_time(self, nbytes):
+        """Emulate the duration of a USB transfer of 'nbytes'"""
+        self.transfers += 1
+        delay = self.latency
+        if self.bandwidth:
+            delay += nbytes / self.bandwidth
+        if delay > 0:
+            time.sleep(delay)
+
+    def exchange(self, out=b'', readlen=0):
+        """SPI port exchange: one transaction in one USB transfer"""
+        self._transfer_time(len(out) + readlen)
+        return self._transaction(bytes(out), readlen)
+
+    def _exchange_many(self, transactions):
+        """Run several SPI transactions in one emulated USB transfer"""
+        self._transfer_time(sum(len(wbytes) + readlen for wbytes, readlen in transactions))
+        return [self._transaction(bytes(wbytes), readlen) for wbytes, readlen in transactions]
+
+    def _transaction(self, wbytes, readlen):
+        """Decode and apply one SPI transaction"""
+        ctrl_word = int.from_bytes(wbytes[:3], byteorder='big')
+        wr = (ctrl_word >> 23) & 1
+        incr = (ctrl_word >> 22) & 1
+        length = ((ctrl_word >> 8) & 0x3FFF) + 1
+        addr = ctrl_word & 0xFF
+        self.bytes_out += len(wbytes)
+        self.bytes_in += readlen
+        if wr:
+            data = self._bytes_to_words(wbytes[3:3 + 2 * length])
+            if incr:
+                for i, word in enumerate(data):
+                    self._write_reg((addr + i) & 0xFF, word)
+            else:
+                for word in data:
+                    self._write_reg(addr, word)
+            return b''
+        if addr == CsrMap.RAMDATA_ADDR and not incr:
+            words = self._read_ram(length)
+        elif incr:
+            words = np.array([self._read_reg((addr + i) & 0xFF) for i in range(length)], dtype='>u2')
+        else:
+            words = np.array([self._read_reg(addr) for _ in range(length)], dtype='>u2')
+        return words.astype('>u2', copy=False).tobytes()[:readlen]
+
+    def _write_reg(self, addr, word):
+        """Write one register, with its side effects"""
+        if CsrMap.DACGAIN_ADDR <= addr < CsrMap.DACGAIN_ADDR + CsrMap.DACGAIN_N:
+            self._gain[addr - CsrMap.DACGAIN_ADDR] = word & CsrMap.DACGAIN_MASK
+        elif addr == CsrMap.ACQSTART_ADDR:
+            if word & CsrMap.ACQSTART_MASK:
+                self._start_acquisition()
+        elif addr == CsrMap.RAMRADDRRST_ADDR:
+            if word & CsrMap.RAMRADDRRST_MASK:
+                self._raddr = 0
+        elif addr == CsrMap.RAMFINC_ADDR:
+            if word & CsrMap.RAMFINC_MASK:
+                self._ram.reshape(-1)[:] = np.arange(self._ram.size, dtype=np.uint32).astype(np.uint16)
+                self._ramfdone = 1
+        elif addr == CsrMap.RAMFDEC_ADDR:
+            if word & CsrMap.RAMFDEC_MASK:
+                self._ram.reshape(-1)[:] = (-np.arange(1, self._ram.size + 1, dtype=np.int64)).astype(np.uint16)
+                self._ramfdone = 1
+        elif addr not in CsrMap.VOLATILE_ADDRS:
+            self._regs[addr] = word
+
+    def _read_reg(self, addr):
+        """Read one register"""
+        if CsrMap.DACGAIN_ADDR <= addr < CsrMap.DACGAIN_ADDR + CsrMap.DACGAIN_N:
+            return self._gain[addr - CsrMap.DACGAIN_ADDR]
+        if addr == CsrMap.ACQDONE_ADDR:
+            return int(self._acq_done())
+        if addr == CsrMap.ACQBUSY_ADDR:
+            return int(self._done_at is not None and not self._acq_done())
+        if addr == CsrMap.RAMFDONE_ADDR:
+            return self._ramfdone
+        if addr == CsrMap.RAMDATA_ADDR:
+            return int(self._read_ram(1)[0])
+        return self._regs.get(addr, 0)
+
+    def _acq_done(self):
+        return self._done_at is not None and time.perf_counter() >= self._done_at
+
+    def _read_ram(self, length):
+        """Read 'length' words from RAM, auto-incrementing the read address"""
+        flat = self._ram.reshape(-1)
+        if self._raddr + length <= flat.size:
+            words = flat[self._raddr:self._raddr + length]
+        else:
+            words = np.take(flat, np.arange(self._raddr, self._raddr + length), mode='wrap')
+        self._raddr = (self._raddr + length) % flat.size
+        return words
+
+    def acq_duration(self, nblines):
+        """Duration of an acquisition of 'nblines' lines with current registers, in seconds"""
+        pulse = sum(self._regs.get(addr, 0) for addr in (CsrMap.INITDEL_ADDR, CsrMap.PONW_ADDR,
+                                                          CsrMap.INTERW_ADDR, CsrMap.POFFW_ADDR)) + 4
+        return acq_time(nblines, pulse, CsrMap.RAMDATA_N)
+
+    def _template(self, drmode, odd):
+        """Noise-free line for the current gain table (cached)"""
+        key = (tuple(self._gain), drmode and odd)
+        line = self._templates.get(key)
+        if line is None:
+            n = CsrMap.RAMDATA_N
+            t_us = (np.arange(n) + (0.5 if key[1] else 0.0)) / (SAMPLE_CLOCK / 1E6)
+            sig = np.zeros(n)
+            for t_echo, amp in self.ECHOES:
+                env = np.exp(-((t_us - t_echo) / 0.5) ** 2)
+                sig += amp * env * np.sin(2 * np.pi * self.ECHO_FREQ * (t_us - t_echo))
+            gain = np.repeat(np.array(self._gain, dtype=float), n // CsrMap.DACGAIN_N) / CsrMap.DACGAIN_MASK
+            line = np.clip(np.rint(sig * gain), -500, 500).astype(np.int16)
+            if len(self._templates) > 16:
+                self._templates.clear()
+            self._templates[key] = line
+        return line
+
+    def _start_acquisition(self):
+        """Fill RAM with NBLINES+1 synthetic lines and schedule ACQDONE"""
+        nblines = (self._regs.get(CsrMap.NBLINES_ADDR, 0) & CsrMap.NBLINES_MASK) + 1
+        nblines = min(nblines, self.RAM_LINES)
+        drmode = self._regs.get(CsrMap.DRMODE_ADDR, 0) & CsrMap.DRMODE_MASK
+        rows = self._rng.integers(0, len(self._noise), nblines)
+        for i in range(nblines):
+            line = self._template(drmode, i % 2) + self._noise[rows[i]] + 512
+            np.clip(line, 0, 1023, out=line)
+            self._ram[i] = line
+        self._done_at = time.perf_counter() + (self.acq_duration(nblines) if self.realtime else 0)
+
+    def reset_logic_on(self):
+        """Activate reset pin ICE_RESET_FT"""
+        self.reset_logic()
+
+    def reset_logic_off(self):
+        """Deactivate reset pin ICE_RESET_FT"""
+
+    def reset_config_on(self):
+        """Activate reset pin ICE_RESET"""
+        self.reload_config()
+
+    def reset_config_off(self):
+        """Deactivate reset pin ICE_RESET"""
+
+    def close_connection(self):
+        """Nothing to close"""
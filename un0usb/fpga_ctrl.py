@@ -5,31 +5,138 @@ Main FPGA control script
 import numpy as np
 import datetime
 
-from time import sleep
+from time import sleep, perf_counter
 from un0usb.csr_map import CsrMap
 from un0usb.ftdi_dev import FtdiDevice
+from un0usb.capture import codes_to_voltage
+from un0usb.signal_utils import time_axis, acq_time, SAMPLE_CLOCK, PULSER_CLOCK
+from un0usb.emulator import EmuDevice, is_emulator_url
+from un0usb.stats import Instrumentation
 from .version import __version__
 
+class AcquisitionTimeoutError(RuntimeError):
+    """Acquisition was not done (ACQDONE) within the allowed time"""
+
+
+class WaitStats(object):
+    """Statistics of the acquisition completion waits"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Clear all statistics"""
+        self.count = 0
+        self.timeouts = 0
+        self.polls = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.last = None
+        self.last_predicted = None
+
+    def update(self, elapsed, predicted, polls):
+        """Account one completed wait"""
+        self.count += 1
+        self.polls += polls
+        self.total += elapsed
+        self.min = elapsed if self.min is None else min(self.min, elapsed)
+        self.max = elapsed if self.max is None else max(self.max, elapsed)
+        self.last = elapsed
+        self.last_predicted = predicted
+
+    @property
+    def mean(self):
+        """Mean wait duration, in seconds"""
+        return self.total / self.count if self.count else None
+
+    def as_dict(self):
+        """Return statistics as a dictionnary"""
+        return {"count": self.count,
+                "timeouts": self.timeouts,
+                "polls": self.polls,
+                "total": self.total,
+                "mean": self.mean,
+                "min": self.min,
+                "max": self.max,
+                "last": self.last,
+                "last_predicted": self.last_predicted}
+
+
 class FpgaControl(object):
     """Collection of FPGA control functions via FTDI API"""
+    # stats.Instrumentation shared with the FTDI device, None - disabled
+    stats = None
     MAX_LINES = 32
     WORDS_PER_LINE = 16384
+    SAMPLE_W = 10
+    SAMPLE_N = 2 ** SAMPLE_W
+    # ADC full scale, volts
+    V_REF = 2 * 1.0
+    # ADC code (masked to SAMPLE_W bits) to voltage lookup table
+    VOLTAGE_LUT = codes_to_voltage(np.arange(SAMPLE_N), SAMPLE_W, V_REF)
+    _voltage_luts = {np.dtype(np.float64): VOLTAGE_LUT}
+    # ADC and pulser clocks, Hz
+    SAMPLE_CLOCK = SAMPLE_CLOCK
+    PULSER_CLOCK = PULSER_CLOCK
+    # default cubic gain curve used when no gain is given to do_acquisition()
+    DEFAULT_GAIN = tuple(int(100 + ((1000-100)*x*x*x/32/32/32)) for x in range(32))
 
     def __init__(self, ftdi_url, spi_freq=1E6):
         """Initialize FPGA controller.
 
         Keyword arguments:
-         ftdi_url -- FTDI device url, which can be obtained by Ftdi.show_devices()
+         ftdi_url -- FTDI device url, which can be obtained by Ftdi.show_devices(),
+                     or 'emu://' for the board emulator (see emulator.EmuDevice)
          freq -- SPI frequency up to 8E6 (for FPGA running on 64 MHz)
         """
-        self._ftdi = FtdiDevice(ftdi_url, spi_freq)
+        if is_emulator_url(ftdi_url):
+            self._ftdi = EmuDevice(ftdi_url, spi_freq)
+        else:
+            self._ftdi = FtdiDevice(ftdi_url, spi_freq)
         self.csr = CsrMap(self._ftdi)
+        # acquisition completion wait: sleep up to 'wait_margin' of the predicted
+        # duration, then poll ACQDONE every 'poll_min' seconds, multiplied by
+        # 'poll_backoff' after each poll up to 'poll_max', for 'acq_timeout' seconds max
+        self.wait_margin = 0.9
+        self.poll_min = 50E-6
+        self.poll_max = 0.01
+        self.poll_backoff = 2.0
+        self.acq_timeout = 2.0
+        self.wait_stats = WaitStats()
+
+    def enable_stats(self, hooks=None):
+        """Start recording per-stage statistics (see stats.Instrumentation).
+
+        Keyword arguments:
+          hooks -- callbacks called as hook(stage, elapsed, bytes_in, bytes_out)
+        Return:
+          the Instrumentation, also available as 'stats'
+        """
+        self.stats = Instrumentation(hooks)
+        self._ftdi.stats = self.stats
+        return self.stats
+
+    def disable_stats(self):
+        """Stop recording statistics"""
+        self.stats = None
+        self._ftdi.stats = None
+
+    def stats_snapshot(self):
+        """Return statistics by stage as a dictionnary, None if disabled"""
+        return None if self.stats is None else self.stats.snapshot()
+
+    def _record(self, stage, start, bytes_in=0, bytes_out=0):
+        """Account a stage started at 'start' (perf_counter) if stats are enabled"""
+        if self.stats is not None and start is not None:
+            self.stats.record(stage, perf_counter() - start, bytes_in, bytes_out)
 
     def reset(self):
         """Reset FPGA logic"""
         self._ftdi.reset_logic_on()
         sleep(0.01)
         self._ftdi.reset_logic_off()
+        self.csr.invalidate()
 
     def reload(self):
         """Reload FPGA configuration from flash"""
@@ -37,20 +144,36 @@ class FpgaControl(object):
         sleep(0.01)
         self._ftdi.reset_config_off()
         sleep(0.5)
+        self.csr.invalidate()
 
-    def read_lines(self, n):
+    def read_lines(self, n, out=None):
         """Read 'n' number of lines from SRAM buffer
 
         Maxinum 'n' -- 32
+
+        Keyword arguments:
+          out -- optional preallocated uint16 array with shape (>= n, 16384),
+                 filled in place row by row (can be reused between acquisitions)
+        Return:
+          uint16 array with shape (n, 16384) -- a view of 'out' if it is given
         """
+        start = perf_counter() if self.stats is not None else None
+        if out is None:
+            out = np.empty((n, self.WORDS_PER_LINE), dtype=np.uint16)
+        elif out.ndim != 2 or out.shape[0] < n or out.shape[1] != self.WORDS_PER_LINE:
+            raise ValueError("'out' buffer shape %s can't hold %d lines of %d words" %
+                             (out.shape, n, self.WORDS_PER_LINE))
         # reset external ram address to read from the memory beginning
         self.csr.ramraddrrst = 1
-        res = []
-        for _ in range(n):
+        for i in range(n):
             # read lines (16384 words per line) one by one
-            line = self.csr.ramdata
-            res += [line]
-        return res
+            out[i] = self.csr.ramdata
+        self._record('read_lines', start, bytes_in=out[:n].nbytes)
+        return out[:n]
+
+    def alloc_lines(self, n=MAX_LINES):
+        """Allocate a buffer for read_lines(out=...) able to hold 'n' lines"""
+        return np.empty((n, self.WORDS_PER_LINE), dtype=np.uint16)
 
     def set_pulseform(self, initDelay=5, POn=16, PInter=16, Poff=5000):
         """Set pulser.
@@ -69,14 +192,35 @@ class FpgaControl(object):
           PInter -- time between Pon and PDamp
           Poff -- damping period
         """
-        if initDelay:
-            self.csr.initdel= initDelay
-        if POn:
-            self.csr.ponw = POn
-        if PInter:
-            self.csr.interw = PInter
-        if Poff:
-            self.csr.poffw = Poff
+        # registers written in address order, so they merge in one burst
+        with self.csr.batch():
+            if initDelay:
+                self.csr.initdel= initDelay
+            if POn:
+                self.csr.ponw = POn
+            if Poff:
+                self.csr.poffw = Poff
+            if PInter:
+                self.csr.interw = PInter
+
+    def set_gain(self, gain):
+        """Upload gain table, skipping the registers already holding these values.
+
+        Registers are compared with the CsrMap shadow cache: the whole table is
+        uploaded when it is disabled or doesn't know all gain registers.
+
+        Keyword arguments:
+          gain -- list with 32 gain values
+        """
+        gain = [int(g) & CsrMap.DACGAIN_MASK for g in gain]
+        last = self.csr.shadowed(CsrMap.DACGAIN_ADDR, len(gain), burst='incr')
+        if last is None:
+            self.csr.dacgain = gain
+        else:
+            changed = [i for i, (g, l) in enumerate(zip(gain, last)) if g != l]
+            if changed:
+                # upload the smallest contiguous span covering all changes
+                self.csr.write_dacgain(gain[changed[0]:changed[-1] + 1], start=changed[0])
 
     def stdNDTacq(self):
         """Do standard acquisition - 32lines, interleaved, standard gain.
@@ -85,52 +229,161 @@ class FpgaControl(object):
         now = datetime.datetime.today().strftime('%Y%m%d%H%M%S')
         return self.save(name_file=now+"_ndt")
 
-    def do_acquisition(self, acq_lines=1, gain=None, double_rate=False):
+    def do_acquisition(self, acq_lines=1, gain=None, double_rate=False, out=None):
         """Do acquisitions.
         
         Keyword arguments:
           acq_lines -- number of lines to sample: int 1 .. 32
           gain -- list with gain values: None or list with length of 32
           double_rate -- enable/disable interleaving mode: bool
+          out -- optional preallocated buffer passed to read_lines()
         """
-        if gain:
-            self.csr.dacgain = gain
-        else:
-            gain = [int(100 + ((1000-100)*x*x*x/32/32/32)) for x in range(32)]
-            self.csr.dacgain = gain
-        self.csr.nblines = acq_lines - 1
-        self.csr.drmode = int(double_rate)
-        self.csr.acqstart = 1
-        while (not self.csr.acqdone):
-            sleep(0.01)
-        return self.read_lines(acq_lines)
+        start = perf_counter() if self.stats is not None else None
+        self.start_acquisition(acq_lines, gain, double_rate)
+        self.wait_acquisition(acq_lines)
+        lines = self.read_lines(acq_lines, out=out)
+        self._record('acquisition', start)
+        return lines
+
+    def start_acquisition(self, acq_lines=1, gain=None, double_rate=False):
+        """Configure and start an acquisition, without waiting for it.
+
+        Keyword arguments: see do_acquisition()
+        """
+        with self.csr.batch():
+            if gain is None or not len(gain):
+                gain = self.DEFAULT_GAIN
+            self.set_gain(gain)
+            self.csr.drmode = int(double_rate)
+            self.csr.nblines = acq_lines - 1
+            self.csr.acqstart = 1
+
+    def predict_acq_time(self, acq_lines):
+        """Predict duration of an acquisition of 'acq_lines' lines, in seconds.
+
+        Every line is the pulse sequence (INITDEL, PONW, INTERW, POFFW periods
+        of the pulser clock) followed by WORDS_PER_LINE samples, see
+        signal_utils.acq_time().
+        """
+        pulse = (self.csr.initdel + self.csr.ponw + self.csr.interw + self.csr.poffw + 4)
+        return acq_time(acq_lines, pulse, self.WORDS_PER_LINE, self.SAMPLE_CLOCK, self.PULSER_CLOCK)
+
+    def wait_acquisition(self, acq_lines, timeout=None):
+        """Wait for the end of a started acquisition (ACQDONE).
+
+        Sleeps until just before the predicted end, then polls with back-off
+        (see wait_schedule).
+
+        Keyword arguments:
+          acq_lines -- number of lines of the acquisition
+          timeout -- seconds to wait before raising AcquisitionTimeoutError,
+                     'acq_timeout' attribute if None
+        Return:
+          time waited, in seconds
+        """
+        schedule = self.wait_schedule(acq_lines, timeout)
+        delay = next(schedule)
+        while True:
+            if delay > 0:
+                sleep(delay)
+            try:
+                delay = schedule.send(self.csr.acqdone)
+            except StopIteration as stop:
+                return stop.value
+
+    def wait_schedule(self, acq_lines, timeout=None):
+        """Acquisition completion wait policy, as a generator.
+
+        Yields the seconds to sleep before the next ACQDONE poll, and
+        expects the polled ACQDONE value to be sent back, so the caller
+        decides how to sleep and poll (see wait_acquisition). Only the first
+        step accesses the board, to predict the acquisition duration.
+        Accounts the wait in 'wait_stats' and returns (StopIteration value)
+        the time waited, in seconds.
+
+        Keyword arguments: see wait_acquisition()
+        """
+        start = perf_counter()
+        if timeout is None:
+            timeout = self.acq_timeout
+        predicted = self.predict_acq_time(acq_lines)
+        early = predicted * self.wait_margin - (perf_counter() - start)
+        done = yield max(early, 0.0)
+        poll = self.poll_min
+        polls = 1
+        while not done:
+            elapsed = perf_counter() - start
+            if elapsed > timeout:
+                self.wait_stats.timeouts += 1
+                raise AcquisitionTimeoutError("Acquisition of %d lines not done after %.3f s" %
+                                              (acq_lines, elapsed))
+            done = yield poll
+            polls += 1
+            poll = min(poll * self.poll_backoff, self.poll_max)
+        elapsed = perf_counter() - start
+        self.wait_stats.update(elapsed, predicted, polls)
+        self._record('wait', start)
+        return elapsed
 
     def disconnect(self):
         """Disconnect from FTDI and close all open ports"""
         self._ftdi.close_connection()
 
-    def line_to_voltage(self, line):
+    def voltage_lut(self, dtype=np.float64):
+        """Return the ADC code to voltage lookup table in the given dtype"""
+        dtype = np.dtype(dtype)
+        lut = self._voltage_luts.get(dtype)
+        if lut is None:
+            lut = self._voltage_luts[dtype] = self.VOLTAGE_LUT.astype(dtype)
+        return lut
+
+    def line_to_voltage(self, line, dtype=np.float64):
         """Extracting voltage reading from line raw data"""
-        SAMPLE_W = 10
-        SAMPLE_N = 2 ** SAMPLE_W
-        res = [((2 * 1.0) / SAMPLE_N) * ((w & (SAMPLE_N - 1)) - SAMPLE_N // 2) for w in line]
-        return np.array(res)
+        return self.lines_to_voltage(line, dtype=dtype)
+
+    def lines_to_voltage(self, lines, dtype=np.float64, out=None):
+        """Extracting voltage readings from raw data of any shape at once.
 
-    def get_data(self):
+        Keyword arguments:
+          lines -- raw words: one line or a (n, 16384) block from read_lines()
+          dtype -- output dtype: np.float32 or np.float64
+          out -- optional preallocated output array with the shape of 'lines'
         """
-        Return the last measurement datas into a dictionnary
+        start = perf_counter() if self.stats is not None else None
+        codes = np.bitwise_and(lines, self.SAMPLE_N - 1)
+        res = np.take(self.voltage_lut(dtype), codes, out=out)
+        self._record('convert', start)
+        return res
+
+    def acq_settings(self):
+        """Return the current acquisition settings into a dictionnary.
+
+        Configuration registers are shadowed, so this is usually free of SPI traffic.
         """
-        acq_res = self.read_lines(self.csr.nblines + 1)
-        all_acqs = []
+        return {"nblines": int(self.csr.nblines + 1),
+                "gain": self.csr.dacgain,
+                "t_on": self.csr.ponw,
+                "dac": self.csr.dacout,
+                "t_inter": self.csr.interw,
+                "t_off": self.csr.poffw,
+                "t_delay": self.csr.initdel,
+                "doublerate": self.csr.drmode}
 
-        for _, acq in enumerate(acq_res):
-            all_acqs.append(self.line_to_voltage(acq))
+    def get_data(self, raw=False):
+        """
+        Return the last measurement datas into a dictionnary
+
+        Keyword arguments:
+          raw -- keep the masked ADC codes (uint16) in "raw", with the conversion
+                 constants "sample_w" and "v_ref", instead of voltages in "signal"
+        """
+        nblines = self.csr.nblines + 1
+        acq_res = self.read_lines(nblines)
 
-        t_axis = [x*256.0/len(acq_res[0]) for x in range(len(acq_res[0]))]
+        t_axis = time_axis(acq_res.shape[1], False, self.SAMPLE_CLOCK)
         now = datetime.datetime.today().strftime('%Y%m%d%H%M%S')
-        data = {"signal": all_acqs,
-                "t": t_axis,
-                "nblines": int(self.csr.nblines+1),
+        data = {"t": t_axis,
+                "nblines": int(nblines),
                 "gain": self.csr.dacgain,
                 "t_on": self.csr.ponw, 
                 "dac": self.csr.dacout,
@@ -143,17 +396,34 @@ class FpgaControl(object):
                 "libversion": str(__version__),
                 "timestamp": str(now),
                 "nameFile": None}
+        if raw:
+            data["raw"] = np.bitwise_and(acq_res, self.SAMPLE_N - 1)
+            data["sample_w"] = self.SAMPLE_W
+            data["v_ref"] = self.V_REF
+        else:
+            data["signal"] = self.lines_to_voltage(acq_res)
         return data
 
-    def save(self, name_file=None):
-        """Save just one acquisition in npz file format"""
-        data = self.get_data()
+    def save(self, name_file=None, raw=True):
+        """Save just one acquisition in npz file format
+
+        Keyword arguments:
+          name_file -- file name without extension, timestamp if None
+          raw -- save ADC codes instead of float64 voltages (4 times smaller),
+                 see capture.load_capture() to read both formats
+        Raw captures have "raw", "sample_w" and "v_ref" instead of "signal":
+        np.load(...)["signal"] raises a KeyError on them, use
+        capture.load_capture() (or raw=False for the previous format).
+        """
+        start = perf_counter() if self.stats is not None else None
+        data = self.get_data(raw=raw)
         if name_file is None:
             name_file = data["timestamp"]
 
         data["nameFile"] = str(name_file)
         np.savez_compressed(name_file, **data )
 
+        self._record('save', start)
         return name_file+".npz"
 
 class Acquisition(object):
@@ -2,6 +2,10 @@
 Wrapper over FTDI API
 '''
 
+from struct import pack as spack
+from time import perf_counter
+
+import numpy as np
 from pyftdi.ftdi import Ftdi
 from pyftdi.spi import SpiController
 from pyftdi.gpio import GpioAsyncController
@@ -44,6 +48,14 @@ class FtdiDevice:
     GPIO_RESET_LOGIC_POS = 7
     GPIO_RESET_CONFIG_POS = 7
 
+    # stats.Instrumentation recording USB transfers, None - disabled
+    stats = None
+
+    # pyftdi SpiController / SpiPort internals the packed transfer relies on
+    _CTRL_ATTRS = ('_lock', '_frequency', '_clock_phase', '_gpio_low', '_spi_mask',
+                   '_cs_bits', 'direction', 'ftdi')
+    _PORT_ATTRS = ('_frequency', '_cs_prolog', '_cs_epilog')
+
     def __init__(self, ftdi_url, spi_freq=1E6):
         """Configure the FTDI interface.
 
@@ -73,12 +85,15 @@ class FtdiDevice:
 
     def _words_to_bytes(self, words_list):
         """Convert list with 16 bit words to bytes"""
-        bytes_str_list = [self._int_to_bytes(w, length=2) for w in words_list]
-        return b''.join(bytes_str_list)  # concatenate all strings
+        return np.asarray(words_list, dtype='>u2').tobytes()
 
     def _bytes_to_words(self, bytes_str):
         """Convert bytes string to list with 16 bit words"""
-        return [int.from_bytes(bytes_str[b*2:b*2+2], byteorder='big', signed=False) for b in range(len(bytes_str)//2)]
+        return self._bytes_to_array(bytes_str).tolist()
+
+    def _bytes_to_array(self, bytes_str):
+        """Convert bytes string to numpy array with 16 bit words (no copy)"""
+        return np.frombuffer(bytes_str, dtype='>u2', count=len(bytes_str) // 2)
 
     def _prepare_ctrl_word(self, addr, len, burst, wr):
         """Prepare control word for exchange.
@@ -106,9 +121,21 @@ class FtdiDevice:
            Return:
              list of size 'len' with 16 bit data words
         """
-        ctrl_word = self._prepare_ctrl_word(addr, len, burst, wr=0)
-        rbytes = self._spi_port.exchange(self._int_to_bytes(ctrl_word, 3), len * 2)
-        return self._bytes_to_words(rbytes)
+        return self.spi_read_array(addr, len, burst).tolist()
+
+    def spi_read_array(self, addr, len=1, burst='fixed'):
+        """Read data from address via SPI into a numpy array.
+
+           Keyword arguments:
+             addr -- 8 bit address
+             len -- number of 16 bit data words to write/read (2^14 max)
+             burst -- 'fixed' address the same for every data, 'incr' - address + 1 for every next data word
+           Return:
+             read-only numpy array of size 'len' with big-endian 16 bit data words,
+             viewed directly over the received bytes
+        """
+        rbytes = self._exchange(self._read_bytes(addr, len, burst), len * 2)
+        return self._bytes_to_array(rbytes)
 
     def spi_write(self, addr, data, burst='fixed'):
         """Write data to address via SPI.
@@ -118,9 +145,109 @@ class FtdiDevice:
              data -- list with 16 bit data words to write (list length 2^14 max)
              burst -- 'fixed' address the same for every data, 'incr' - address + 1 for every next data word
          """
+        self._exchange(self._write_bytes(addr, data, burst))
+
+    def _exchange(self, wbytes, readlen=0):
+        """One SPI transaction, accounted in 'stats' if enabled"""
+        if self.stats is None:
+            return self._spi_port.exchange(wbytes, readlen)
+        start = perf_counter()
+        rbytes = self._spi_port.exchange(wbytes, readlen)
+        self.stats.record('exchange', perf_counter() - start, readlen, len(wbytes))
+        return rbytes
+
+    def _read_bytes(self, addr, len, burst):
+        """Prepare bytes to send for a read transaction"""
+        return self._int_to_bytes(self._prepare_ctrl_word(addr, len, burst, wr=0), 3)
+
+    def _write_bytes(self, addr, data, burst):
+        """Prepare bytes to send for a write transaction"""
         ctrl_word = self._prepare_ctrl_word(addr, len(data), burst, wr=1)
-        wbytes = self._int_to_bytes(ctrl_word, 3) + self._words_to_bytes(data)
-        self._spi_port.exchange(wbytes)
+        return self._int_to_bytes(ctrl_word, 3) + self._words_to_bytes(data)
+
+    def _mpsse_framing(self):
+        """Return (prolog, epilog) MPSSE commands to select/deselect the FPGA.
+
+        Return None if the pyftdi SPI controller doesn't expose what is
+        needed to pack several transactions in one USB transfer, or isn't
+        set up like a regular mode 0 exchange would leave it (SPI clock
+        frequency and phase). Call it with the controller lock held.
+        """
+        ctrl, port = self._spi_ctrl, self._spi_port
+        if not all(hasattr(ctrl, name) for name in self._CTRL_ATTRS) or \
+           not all(hasattr(port, name) for name in self._PORT_ATTRS):
+            return None
+        if ctrl._frequency != port._frequency or ctrl._clock_phase:
+            # let pyftdi switch the clock with a regular exchange first
+            return None
+        direction = ctrl.direction & 0xFF
+        gpio_low = ctrl._gpio_low
+        prolog = bytearray()
+        for pins in port._cs_prolog:
+            prolog.extend((Ftdi.SET_BITS_LOW, (pins & ctrl._spi_mask) | gpio_low, direction))
+        epilog = bytearray()
+        for pins in port._cs_epilog:
+            epilog.extend((Ftdi.SET_BITS_LOW, (pins & ctrl._spi_mask) | gpio_low, direction))
+        epilog.extend((Ftdi.SET_BITS_LOW, ctrl._cs_bits | gpio_low, direction))
+        return prolog, epilog
+
+    def spi_exchange_many(self, transactions):
+        """Run several SPI transactions in as few USB transfers as possible.
+
+           Keyword arguments:
+             transactions -- list of (bytes to send, number of bytes to read)
+           Return:
+             list with received bytes for every transaction
+        """
+        if self.stats is None:
+            return self._exchange_many(transactions)
+        start = perf_counter()
+        res = self._exchange_many(transactions)
+        self.stats.record('exchange', perf_counter() - start,
+                          sum(readlen for _, readlen in transactions),
+                          sum(len(wbytes) for wbytes, _ in transactions),
+                          items=len(transactions))
+        return res
+
+    def _exchange_many(self, transactions):
+        """Pack several SPI transactions in one MPSSE command buffer"""
+        rbytes = None
+        lock = getattr(self._spi_ctrl, '_lock', None)
+        if lock is not None:
+            with lock:
+                framing = self._mpsse_framing()
+                if framing is not None:
+                    rbytes = self._exchange_packed(transactions, *framing)
+        if rbytes is None:
+            # nothing sent yet: fallback to one exchange per transaction
+            return [self._spi_port.exchange(wbytes, readlen) for wbytes, readlen in transactions]
+        res = []
+        offset = 0
+        for _, readlen in transactions:
+            res += [rbytes[offset:offset + readlen]]
+            offset += readlen
+        return res
+
+    def _exchange_packed(self, transactions, prolog, epilog):
+        """Send all transactions in one USB transfer. Return all received bytes"""
+        cmd = bytearray()
+        for wbytes, readlen in transactions:
+            cmd.extend(prolog)
+            cmd.extend(spack('<BH', Ftdi.WRITE_BYTES_NVE_MSB, len(wbytes) - 1))
+            cmd.extend(wbytes)
+            if readlen:
+                cmd.extend(spack('<BH', Ftdi.READ_BYTES_NVE_MSB, readlen - 1))
+            cmd.extend(epilog)
+        readlen_total = sum(readlen for _, readlen in transactions)
+        if readlen_total:
+            cmd.append(Ftdi.SEND_IMMEDIATE)
+        ftdi = self._spi_ctrl.ftdi
+        ftdi.write_data(cmd)
+        return ftdi.read_data_bytes(readlen_total, 4) if readlen_total else b''
+
+    def batch(self):
+        """Start a batch of SPI transactions sent together (see SpiBatch)"""
+        return SpiBatch(self)
 
     def reset_logic_on(self):
         """Activate reset pin ICE_RESET_FT"""
@@ -143,5 +270,94 @@ class FtdiDevice:
         self._spi_ctrl.terminate()
         self._gpio_ctrl.close()
 
+
+class SpiBatch:
+    """Queue of SPI transactions flushed in one go.
+
+    Queued operations keep their order. Adjacent single word (or 'incr')
+    accesses to contiguous addresses with the same direction are merged into
+    one 'incr' burst, then all transactions are packed in a single USB
+    transfer by FtdiDevice.spi_exchange_many().
+
+    Usage:
+        with ftdidev.batch() as b:
+            b.write(0x00, [5])
+            b.write(0x01, [16])
+            b.read(0x52)
+        print(b.results)  # [[nblines]]
+    """
+
+    def __init__(self, ftdidev):
+        self._ftdi = ftdidev
+        self._ops = []
+        self._nreads = 0
+        self.results = []
+
+    def __len__(self):
+        return len(self._ops)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        else:
+            self._ops = []
+            self._nreads = len(self.results)
+
+    def read(self, addr, len=1, burst='fixed'):
+        """Queue read transaction. Return index of its data in 'results'"""
+        self._queue(0, addr, len, burst, None)
+        self._nreads += 1
+        return self._nreads - 1
+
+    def write(self, addr, data, burst='fixed'):
+        """Queue write transaction"""
+        self._queue(1, addr, len(data), burst, list(data))
+
+    def _queue(self, wr, addr, length, burst, data):
+        if length == 1:
+            burst = 'incr'
+        if self._ops and burst == 'incr':
+            last = self._ops[-1]
+            last_wr, last_addr, last_len, last_burst, last_data = last
+            if (last_wr == wr and last_burst == 'incr' and last_addr + last_len == addr and
+                    last_len + length <= 2 ** 14):
+                if wr:
+                    last_data += data
+                else:
+                    last_data += [length]
+                self._ops[-1] = (wr, last_addr, last_len + length, burst, last_data)
+                return
+        self._ops += [(wr, addr, length, burst, data if wr else [length])]
+
+    def flush(self):
+        """Send all queued transactions.
+
+           Return:
+             list with data words of every queued read, in queue order
+        """
+        ops, self._ops = self._ops, []
+        if not ops:
+            return self.results
+        transactions = []
+        for wr, addr, length, burst, data in ops:
+            if wr:
+                transactions += [(self._ftdi._write_bytes(addr, data, burst), 0)]
+            else:
+                transactions += [(self._ftdi._read_bytes(addr, length, burst), length * 2)]
+        rbytes = self._ftdi.spi_exchange_many(transactions)
+        for (wr, _, _, _, lengths), rb in zip(ops, rbytes):
+            if wr:
+                continue
+            words = self._ftdi._bytes_to_words(rb)
+            offset = 0
+            for length in lengths:
+                self.results += [words[offset:offset + length]]
+                offset += length
+        return self.results
+
+
 if __name__ == "__main__":
     Ftdi.show_devices()
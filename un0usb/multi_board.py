@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Acquisitions on several un0rick boards from one process: one I/O
+    thread per board, acquisitions triggered in lockstep, round-robin or
+    free running, and all frames delivered through a single stream,
+    tagged with their board and sequence number.
+
+        urls = discover_boards()  # or e.g. ["emu://?seed=1", "emu://?seed=2"]
+        with MultiBoardManager(urls, acq_lines=32, mode=LOCKSTEP) as boards:
+            for frame in boards:
+                print(frame.board, frame.seq, frame.lines.shape)
+"""
+import queue
+import threading
+import time
+
+from .acq_pipeline import Frame, DROP_OLDEST, BLOCK, get_frame, put_frame
+from .fpga_ctrl import FpgaControl
+
+# every board acquires at the same time, cycle after cycle
+LOCKSTEP = "lockstep"
+# boards acquire one after the other (no acoustic crosstalk between cells)
+ROUND_ROBIN = "round_robin"
+# boards acquire independently, as fast as they can
+FREE_RUN = "free_run"
+MODES = (LOCKSTEP, ROUND_ROBIN, FREE_RUN)
+
+
+def discover_boards():
+    """Return the urls of the connected FT2232H (un0rick) boards, by serial number"""
+    from pyftdi.ftdi import Ftdi
+    urls = []
+    for desc, _ in Ftdi.list_devices('ftdi://ftdi:2232/1'):
+        if desc.sn:
+            url = 'ftdi://ftdi:2232:%s/' % desc.sn
+        else:
+            # pyftdi reads the bus:address locator as hexadecimal
+            url = 'ftdi://ftdi:2232:%x:%x/' % (desc.bus, desc.address)
+        if url not in urls:
+            urls += [url]
+    return urls
+
+
+class BoardFrame(Frame):
+    """One acquisition of one of the boards"""
+
+    def __init__(self, board, seq, timestamp, lines):
+        super().__init__(seq, timestamp, lines, None)
+        # index of the board in MultiBoardManager.urls
+        self.board = board
+
+
+class BoardStats(object):
+    """Counters of one board worker"""
+
+    def __init__(self):
+        self.frames = 0
+        self.dropped = 0
+        self.bytes = 0
+        self.busy = 0.0
+
+    def as_dict(self, elapsed):
+        """Return counters and rates over 'elapsed' seconds as a dictionnary"""
+        return {"frames": self.frames,
+                "dropped": self.dropped,
+                "bytes": self.bytes,
+                "busy_s": self.busy,
+                "frames_per_s": self.frames / elapsed if elapsed else None,
+                "mbytes_per_s": self.bytes / elapsed / 1E6 if elapsed else None}
+
+
+class MultiBoardManager(object):
+    """Acquisition threads driving several boards, merged in one frame stream"""
+
+    def __init__(self, urls, acq_lines=32, double_rate=True, gain=None, mode=LOCKSTEP,
+                 queue_size=8, policy=DROP_OLDEST, spi_freq=8E6, init=True):
+        """
+        Parameters
+        ----------
+        urls : list of str, or list of FpgaControl
+            Board urls (see discover_boards, 'emu://' urls are emulated
+            boards), or already opened boards.
+
+        acq_lines, double_rate, gain :
+            Acquisition settings of all boards, see FpgaControl.do_acquisition.
+
+        mode : str
+            'lockstep', 'round_robin' or 'free_run'.
+
+        queue_size : int
+            Frames buffered in the output stream.
+
+        policy : str
+            'drop_oldest' or 'block' when the output stream is full.
+
+        spi_freq : float
+            SPI frequency of the boards opened from urls.
+
+        init : bool
+            Reload and reset the boards opened from urls.
+        """
+        if mode not in MODES:
+            raise ValueError("Unknown acquisition mode: %s" % mode)
+        if policy not in (DROP_OLDEST, BLOCK):
+            raise ValueError("Unknown backpressure policy: %s" % policy)
+        if not urls:
+            raise ValueError("No board to acquire from")
+        self.boards = []
+        self.urls = []
+        # boards opened from urls, disconnected by close()
+        self._owned = []
+        try:
+            for url in urls:
+                if isinstance(url, FpgaControl):
+                    fpga = url
+                else:
+                    fpga = FpgaControl(url, spi_freq=spi_freq)
+                    self._owned += [fpga]
+                    if init:
+                        fpga.reload()
+                        fpga.reset()
+                self.boards += [fpga]
+                self.urls += [url if isinstance(url, str) else None]
+        except Exception:
+            # don't leave the boards opened so far connected
+            for fpga in self._owned:
+                fpga.disconnect()
+            raise
+        self.acq_lines = acq_lines
+        self.double_rate = double_rate
+        self.gain = gain
+        self.mode = mode
+        self.policy = policy
+
+        self._out = queue.Queue(queue_size)
+        self._stop = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._barrier = threading.Barrier(len(self.boards))
+        self._turn = threading.Condition()
+        self._next_board = 0
+        self.error = None
+        self.delivered = 0
+        self.started = None
+        self.board_stats = [BoardStats() for _ in self.boards]
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        while True:
+            yield self.get()
+
+    def __len__(self):
+        return len(self.boards)
+
+    def start(self):
+        """Start one acquisition thread per board"""
+        self._stop.clear()
+        self._barrier.reset()
+        self.started = time.perf_counter()
+        self._threads = [threading.Thread(target=self._run, args=(i,),
+                                          name="un0rick-board%d" % i, daemon=True)
+                         for i in range(len(self.boards))]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=2.0):
+        """Stop all acquisition threads"""
+        self._stop_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def close(self):
+        """Stop, and disconnect the boards opened from urls.
+
+        Boards given as FpgaControl are left connected to their owner.
+        """
+        self.stop()
+        for fpga in self._owned:
+            fpga.disconnect()
+        self._owned = []
+
+    @property
+    def running(self):
+        """True while the acquisition threads are alive"""
+        return any(thread.is_alive() for thread in self._threads)
+
+    def get(self, timeout=None):
+        """Return the next BoardFrame, from any board.
+
+        Raises the error of a failed board thread, or queue.Empty on timeout.
+        """
+        frame = get_frame(self._out, timeout, lambda: self.error)
+        with self._lock:
+            self.delivered += 1
+        return frame
+
+    def stats(self):
+        """Return per board and aggregate counters as a dictionnary"""
+        elapsed = time.perf_counter() - self.started if self.started is not None else 0.0
+        with self._lock:
+            boards = [stats.as_dict(elapsed) for stats in self.board_stats]
+            delivered = self.delivered
+        total = {key: sum(board[key] for board in boards)
+                 for key in ("frames", "dropped", "bytes")}
+        total["frames_per_s"] = total["frames"] / elapsed if elapsed else None
+        total["mbytes_per_s"] = total["bytes"] / elapsed / 1E6 if elapsed else None
+        total["delivered"] = delivered
+        total["queue"] = self._out.qsize()
+        total["elapsed_s"] = elapsed
+        return {"mode": self.mode, "boards": boards, "total": total}
+
+    def _run(self, board):
+        """Acquisition loop of one board, until stopped, recording its error"""
+        try:
+            seq = 0
+            while not self._stop.is_set():
+                if not self._wait_turn(board):
+                    break
+                try:
+                    frame = self._acquire(board, seq)
+                finally:
+                    self._end_turn(board)
+                self._put(frame)
+                seq += 1
+        except Exception as exc:  # pylint: disable=broad-except
+            self.error = exc
+            self._stop_all()
+
+    def _stop_all(self):
+        """Ask all threads to stop, without waiting for them"""
+        self._stop.set()
+        self._barrier.abort()
+        with self._turn:
+            self._turn.notify_all()
+
+    def _wait_turn(self, board):
+        """Wait until 'board' may acquire. False if stopped meanwhile"""
+        if self.mode == LOCKSTEP:
+            try:
+                self._barrier.wait()
+            except threading.BrokenBarrierError:
+                return False
+        elif self.mode == ROUND_ROBIN:
+            with self._turn:
+                while self._next_board != board:
+                    if self._stop.is_set():
+                        return False
+                    self._turn.wait(0.1)
+        return not self._stop.is_set()
+
+    def _end_turn(self, board):
+        """Let the next board acquire (round-robin)"""
+        if self.mode == ROUND_ROBIN:
+            with self._turn:
+                self._next_board = (board + 1) % len(self.boards)
+                self._turn.notify_all()
+
+    def _acquire(self, board, seq):
+        """Do one acquisition on 'board'"""
+        start = time.perf_counter()
+        lines = self.boards[board].do_acquisition(acq_lines=self.acq_lines, gain=self.gain,
+                                                  double_rate=self.double_rate)
+        stats = self.board_stats[board]
+        with self._lock:
+            stats.frames += 1
+            stats.bytes += lines.nbytes
+            stats.busy += time.perf_counter() - start
+        return BoardFrame(board, seq, time.time(), lines)
+
+    def _put(self, frame):
+        """Put frame in the output stream with the backpressure policy"""
+        def on_drop(dropped):
+            with self._lock:
+                self.board_stats[dropped.board].dropped += 1
+        put_frame(self._out, frame, self.policy, self._stop, on_drop)
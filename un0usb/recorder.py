@@ -0,0 +1,278 @@
+'''
+Streaming recorder: appends acquisitions to a single on-disk dataset
+'''
+
+import json
+import os
+import time
+
+import numpy as np
+
+from .version import __version__
+
+
+class Recorder(object):
+    """Append raw acquisitions to a recording directory.
+
+    A recording is a directory with:
+      - header.json -- format description;
+      - lines.u16 -- all raw lines, (total_lines, words_per_line) little
+        endian uint16, appended frame after frame;
+      - frames.bin -- one FRAME_DTYPE record per frame (timestamp, pulse
+        settings, first line index in lines.u16, gain index);
+      - gains.u16 -- table of the distinct gain tables, (n, gain_n) uint16.
+
+    Files are only appended, with bounded write buffers, so a recording can
+    grow without limit and stay readable (see RecordingReader) while written.
+    """
+
+    FORMAT = "un0rick-rec"
+    FORMAT_VERSION = 1
+    FRAME_DTYPE = np.dtype([("seq", "<u8"),
+                            ("timestamp", "<f8"),
+                            ("line_offset", "<u8"),
+                            ("nblines", "<u2"),
+                            ("doublerate", "u1"),
+                            ("t_delay", "<u2"),
+                            ("t_on", "<u2"),
+                            ("t_inter", "<u2"),
+                            ("t_off", "<u2"),
+                            ("dac", "<u2"),
+                            ("gain_index", "<u4")])
+    LINES_FILE = "lines.u16"
+    FRAMES_FILE = "frames.bin"
+    GAINS_FILE = "gains.u16"
+    HEADER_FILE = "header.json"
+
+    def __init__(self, path, words_per_line=16384, gain_n=32,
+                 buffer_size=4 * 2**20, flush_every=32):
+        """Create a recording, or open an existing one to append to it.
+
+        Keyword arguments:
+         path -- recording directory
+         words_per_line -- words in every line (FpgaControl.WORDS_PER_LINE)
+         gain_n -- number of gain values (CsrMap.DACGAIN_N)
+         buffer_size -- write buffer of the lines file, in bytes: all files are
+                        flushed when it is full
+         flush_every -- also flush all files every 'flush_every' frames
+                        (0 - only when the write buffer is full)
+        """
+        self.path = path
+        self.buffer_size = buffer_size
+        self.flush_every = flush_every
+        header_path = os.path.join(path, self.HEADER_FILE)
+        if os.path.exists(header_path):
+            with open(header_path) as header_file:
+                header = json.load(header_file)
+            _check_header(header)
+            words_per_line = header["words_per_line"]
+            gain_n = header["gain_n"]
+        else:
+            os.makedirs(path, exist_ok=True)
+            header = {"format": self.FORMAT,
+                      "format_version": self.FORMAT_VERSION,
+                      "words_per_line": words_per_line,
+                      "gain_n": gain_n,
+                      "frame_dtype": self.FRAME_DTYPE.descr,
+                      "libversion": str(__version__),
+                      "created": time.time()}
+            with open(header_path, "w") as header_file:
+                json.dump(header, header_file)
+        self.words_per_line = words_per_line
+        self.gain_n = gain_n
+
+        # resume from the existing files, dropping any partly written record
+        self._frames = _truncate(os.path.join(path, self.FRAMES_FILE), self.FRAME_DTYPE.itemsize)
+        self._lines = _truncate(os.path.join(path, self.LINES_FILE), words_per_line * 2)
+        self._gains = {}
+        gains_path = os.path.join(path, self.GAINS_FILE)
+        if os.path.exists(gains_path):
+            _truncate(gains_path, gain_n * 2)
+            for i, gain in enumerate(np.fromfile(gains_path, dtype="<u2").reshape(-1, gain_n)):
+                self._gains[tuple(gain.tolist())] = i
+        if self._frames:
+            last = np.fromfile(os.path.join(path, self.FRAMES_FILE), dtype=self.FRAME_DTYPE,
+                               offset=(self._frames - 1) * self.FRAME_DTYPE.itemsize)[0]
+            self._lines = min(self._lines, int(last["line_offset"] + last["nblines"]))
+
+        lines_path = os.path.join(path, self.LINES_FILE)
+        if os.path.exists(lines_path):
+            with open(lines_path, "r+b") as lines_file:
+                lines_file.truncate(self._lines * words_per_line * 2)
+        self._lines_file = open(lines_path, "ab", buffering=buffer_size)
+        self._frames_file = open(os.path.join(path, self.FRAMES_FILE), "ab")
+        # frame records are written after their lines, on flush()
+        self._pending_frames = []
+        # bytes of lines written since the last flush()
+        self._unflushed = 0
+        self._gains_file = open(gains_path, "ab")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self._frames
+
+    def append(self, lines, settings, timestamp=None):
+        """Append one acquisition.
+
+        Keyword arguments:
+         lines -- raw lines, (nblines, words_per_line) uint16 (FpgaControl.read_lines)
+         settings -- dictionnary with "gain", "t_delay", "t_on", "t_inter",
+                     "t_off", "dac", "doublerate" (FpgaControl.acq_settings)
+         timestamp -- acquisition time in seconds since epoch, now if None
+        Return:
+          index of the frame in the recording
+        """
+        lines = np.ascontiguousarray(lines, dtype="<u2")
+        if lines.ndim == 1:
+            lines = lines[np.newaxis]
+        if lines.shape[1] != self.words_per_line:
+            raise ValueError("Lines of %d words expected, got %d" % (self.words_per_line, lines.shape[1]))
+        record = np.zeros(1, dtype=self.FRAME_DTYPE)
+        record["seq"] = self._frames
+        record["timestamp"] = time.time() if timestamp is None else timestamp
+        record["line_offset"] = self._lines
+        record["nblines"] = len(lines)
+        record["doublerate"] = settings.get("doublerate", 0)
+        for key in ("t_delay", "t_on", "t_inter", "t_off", "dac"):
+            record[key] = settings.get(key, 0)
+        record["gain_index"] = self._gain_index(settings.get("gain"))
+
+        if self._unflushed and self._unflushed + lines.nbytes > self.buffer_size:
+            # flush frame records with their lines, rather than letting the
+            # write buffer flush lines alone: memory stays bounded and the
+            # frames become readable
+            self.flush()
+        self._lines_file.write(lines.data)
+        self._unflushed += lines.nbytes
+        self._pending_frames += [record.tobytes()]
+        self._lines += len(lines)
+        self._frames += 1
+        if self.flush_every and not self._frames % self.flush_every:
+            self.flush()
+        return self._frames - 1
+
+    def append_acquisition(self, fpga, lines, timestamp=None):
+        """Append lines acquired by 'fpga' (FpgaControl) with its current settings"""
+        return self.append(lines, fpga.acq_settings(), timestamp)
+
+    def _gain_index(self, gain):
+        """Return index of the gain table, adding it to the table if new"""
+        if gain is None:
+            gain = [0] * self.gain_n
+        key = tuple(int(g) for g in gain)
+        index = self._gains.get(key)
+        if index is None:
+            if len(key) != self.gain_n:
+                raise ValueError("Gain table of %d values expected" % self.gain_n)
+            index = self._gains[key] = len(self._gains)
+            self._gains_file.write(np.array(key, dtype="<u2").tobytes())
+            self._gains_file.flush()
+        return index
+
+    def flush(self):
+        """Write buffered data to disk"""
+        # lines first, so frames on disk always point to written lines
+        self._lines_file.flush()
+        self._gains_file.flush()
+        self._frames_file.write(b"".join(self._pending_frames))
+        self._frames_file.flush()
+        self._pending_frames = []
+        self._unflushed = 0
+
+    def close(self):
+        """Flush and close the recording"""
+        if self._lines_file.closed:
+            return
+        self.flush()
+        self._lines_file.close()
+        self._gains_file.close()
+        self._frames_file.close()
+
+
+class RecordingReader(object):
+    """Random access to a recording written by Recorder, with memory maps.
+
+    The reader sees the frames present when opened (or last refreshed).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, Recorder.HEADER_FILE)) as header_file:
+            self.header = json.load(header_file)
+        _check_header(self.header)
+        self.words_per_line = self.header["words_per_line"]
+        self.gain_n = self.header["gain_n"]
+        self.refresh()
+
+    def refresh(self):
+        """Map the frames written since the reader was opened"""
+        self.frames = _memmap(os.path.join(self.path, Recorder.FRAMES_FILE),
+                              Recorder.FRAME_DTYPE, Recorder.FRAME_DTYPE.itemsize)
+        self.gains = _memmap(os.path.join(self.path, Recorder.GAINS_FILE),
+                             "<u2", self.gain_n * 2).reshape(-1, self.gain_n)
+        self.lines = _memmap(os.path.join(self.path, Recorder.LINES_FILE),
+                             "<u2", self.words_per_line * 2).reshape(-1, self.words_per_line)
+        # ignore frames whose lines or gain are not on disk yet
+        count = len(self.frames)
+        while count and (self.frames[count - 1]["line_offset"] + self.frames[count - 1]["nblines"] > len(self.lines) or
+                         self.frames[count - 1]["gain_index"] >= len(self.gains)):
+            count -= 1
+        self.frames = self.frames[:count]
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, index):
+        """Return (raw lines, frame record) of frame 'index'"""
+        record = self.frames[index]
+        return self.frame_lines(index), record
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def frame_lines(self, index):
+        """Return raw lines of frame 'index', as a read-only view"""
+        record = self.frames[index]
+        start = int(record["line_offset"])
+        return self.lines[start:start + int(record["nblines"])]
+
+    def frame_settings(self, index):
+        """Return settings of frame 'index' as a dictionnary (like FpgaControl.acq_settings)"""
+        record = self.frames[index]
+        settings = {key: int(record[key]) for key in ("nblines", "doublerate", "t_delay",
+                                                      "t_on", "t_inter", "t_off", "dac")}
+        settings["gain"] = self.gains[record["gain_index"]].tolist()
+        settings["timestamp"] = float(record["timestamp"])
+        return settings
+
+
+def _check_header(header):
+    """Check the recording header is readable by this version"""
+    if header.get("format") != Recorder.FORMAT or header.get("format_version", 0) > Recorder.FORMAT_VERSION:
+        raise ValueError("Unsupported recording format: %s version %s" %
+                         (header.get("format"), header.get("format_version")))
+
+
+def _truncate(path, item_size):
+    """Drop partly written item at the end of a file. Return number of items"""
+    if not os.path.exists(path):
+        return 0
+    size = os.path.getsize(path)
+    if size % item_size:
+        with open(path, "r+b") as item_file:
+            item_file.truncate(size - size % item_size)
+    return size // item_size
+
+
+def _memmap(path, dtype, item_size):
+    """Read-only memory map of the complete items of a file"""
+    count = os.path.getsize(path) // item_size if os.path.exists(path) else 0
+    if not count:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(count * item_size // np.dtype(dtype).itemsize,))
@@ -0,0 +1,324 @@
+'''
+Shared memory ring of raw acquisitions, for consumers in other processes
+'''
+
+import os
+import time
+
+import numpy as np
+from multiprocessing import resource_tracker, shared_memory
+
+from .acq_pipeline import Frame
+
+
+class OverrunError(LookupError):
+    """The requested frame was overwritten by the producer (or not written yet)"""
+
+
+class RingFrame(Frame):
+    """One acquisition read from a FrameRingReader"""
+
+    def __init__(self, seq, timestamp, lines, settings):
+        super().__init__(seq, timestamp, lines, None)
+        # acquisition settings, like FpgaControl.acq_settings
+        self.settings = settings
+
+
+class FrameRingWriter(object):
+    """Producer side of a ring of raw acquisitions in shared memory.
+
+    The shared memory block holds:
+      - a header (HEADER_DTYPE) -- format, ring geometry and the sequence
+        number of the next frame to be published;
+      - one SLOT_DTYPE record per slot -- sequence number, timestamp and
+        settings of the frame in the slot;
+      - the slots -- (max_lines, words_per_line) uint16 each.
+
+    Frame 'seq' is written in slot seq % slots. Its record is marked with
+    'seq_begin' before the lines are overwritten and 'seq_end' once the
+    frame is complete, so readers can tell a frame was overwritten while
+    they were using it (see FrameRingReader.valid).
+    """
+
+    MAGIC = 0x756e3052  # "un0R"
+    FORMAT_VERSION = 1
+    HEADER_DTYPE = np.dtype([("magic", "<u4"),
+                             ("format_version", "<u4"),
+                             ("slots", "<u4"),
+                             ("max_lines", "<u4"),
+                             ("words_per_line", "<u4"),
+                             ("gain_n", "<u4"),
+                             ("write_seq", "<u8")])
+    HEADER_SIZE = 64
+    EMPTY = np.iinfo(np.uint64).max
+    GAIN_N = 32
+
+    def __init__(self, name=None, slots=8, max_lines=32, words_per_line=16384):
+        """Create the shared memory ring.
+
+        Keyword arguments:
+         name -- shared memory name, a random one if None (see 'name')
+         slots -- frames kept in the ring
+         max_lines -- lines of the biggest frame (FpgaControl.MAX_LINES)
+         words_per_line -- words in every line (FpgaControl.WORDS_PER_LINE)
+        """
+        slot_dtype = _slot_dtype(self.GAIN_N)
+        size = _data_offset(slots, slot_dtype) + slots * max_lines * words_per_line * 2
+        self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self.name = self._shm.name
+        self.header, self.records, self.data = _views(self._shm.buf, slots, max_lines,
+                                                      words_per_line, slot_dtype)
+        self.records["seq_begin"] = self.EMPTY
+        self.records["seq_end"] = self.EMPTY
+        self.header["slots"] = slots
+        self.header["max_lines"] = max_lines
+        self.header["words_per_line"] = words_per_line
+        self.header["gain_n"] = self.GAIN_N
+        self.header["write_seq"] = 0
+        self.header["format_version"] = self.FORMAT_VERSION
+        self.header["magic"] = self.MAGIC
+        self.slots = slots
+        self.max_lines = max_lines
+        self.words_per_line = words_per_line
+        self.seq = 0
+        self._claimed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def lines_buffer(self):
+        """Claim the next slot and return it as a (max_lines, words_per_line)
+        uint16 array, to acquire directly into shared memory, e.g.
+
+            lines = fpga.do_acquisition(32, out=ring.lines_buffer())
+            ring.publish(lines, fpga.acq_settings())
+        """
+        slot = self.seq % self.slots
+        if not self._claimed:
+            # the previous frame of this slot is invalid from now on
+            self.records["seq_end"][slot] = self.EMPTY
+            self.records["seq_begin"][slot] = self.seq
+            self._claimed = True
+        return self.data[slot]
+
+    def publish(self, lines, settings=None, timestamp=None):
+        """Publish the lines written in lines_buffer() as the next frame.
+
+        Keyword arguments:
+         lines -- the lines acquired in lines_buffer(), (nblines, words_per_line)
+         settings -- dictionnary like FpgaControl.acq_settings, zeros if None
+         timestamp -- acquisition time in seconds since epoch, now if None
+        Return:
+          sequence number of the frame
+        """
+        buf = self.lines_buffer()
+        nblines = len(lines)
+        if not np.shares_memory(lines, buf):
+            raise ValueError("lines are not in the claimed slot, use write()")
+        settings = settings or {}
+        slot = self.seq % self.slots
+        record = self.records
+        record["timestamp"][slot] = time.time() if timestamp is None else timestamp
+        record["nblines"][slot] = nblines
+        record["doublerate"][slot] = settings.get("doublerate", 0)
+        for key in ("t_delay", "t_on", "t_inter", "t_off", "dac"):
+            record[key][slot] = settings.get(key, 0)
+        gain = settings.get("gain")
+        record["gain"][slot] = 0 if gain is None else gain
+        record["seq_end"][slot] = self.seq
+        self.header["write_seq"] = self.seq + 1
+        self._claimed = False
+        self.seq += 1
+        return self.seq - 1
+
+    def write(self, lines, settings=None, timestamp=None):
+        """Copy lines (e.g. from FpgaControl.read_lines) as the next frame.
+
+        Return:
+          sequence number of the frame
+        """
+        lines = np.asarray(lines)
+        if lines.ndim == 1:
+            lines = lines[np.newaxis]
+        if len(lines) > self.max_lines or lines.shape[1] != self.words_per_line:
+            raise ValueError("Frame of shape %s doesn't fit slots of (%d, %d) words" %
+                             (lines.shape, self.max_lines, self.words_per_line))
+        buf = self.lines_buffer()
+        buf[:len(lines)] = lines
+        return self.publish(buf[:len(lines)], settings, timestamp)
+
+    def write_acquisition(self, fpga, lines, timestamp=None):
+        """Copy lines acquired by 'fpga' (FpgaControl) with its current settings"""
+        return self.write(lines, fpga.acq_settings(), timestamp)
+
+    def close(self):
+        """Detach and destroy the ring (attached readers keep their mapping)"""
+        if self._shm is None:
+            return
+        self.header = self.records = self.data = None
+        self._shm.close()
+        if os.name == "posix":
+            # a reader sharing our resource tracker may have unregistered the
+            # block (see _attach): register it again so unlink() can forget it
+            resource_tracker.register(self._shm._name, "shared_memory")
+        self._shm.unlink()
+        self._shm = None
+
+
+class FrameRingReader(object):
+    """Consumer side of a FrameRingWriter ring, attached by name.
+
+    Frames are zero-copy views on the shared memory: a frame stays valid
+    until the writer reuses its slot, 'slots' frames later. Check it
+    with valid() after using it, or copy it.
+    """
+
+    def __init__(self, name, poll=0.5E-3):
+        """Attach to the ring 'name' (FrameRingWriter.name).
+
+        Keyword arguments:
+         name -- shared memory name
+         poll -- seconds between checks for new frames in next()
+        """
+        self._shm = _attach(name)
+        self.name = name
+        header = np.ndarray((), FrameRingWriter.HEADER_DTYPE, self._shm.buf)
+        if header["magic"] != FrameRingWriter.MAGIC or \
+           header["format_version"] > FrameRingWriter.FORMAT_VERSION:
+            self._shm.close()
+            raise ValueError("%s is not a frame ring" % name)
+        self.slots = int(header["slots"])
+        self.max_lines = int(header["max_lines"])
+        self.words_per_line = int(header["words_per_line"])
+        self.header, self.records, self.data = _views(self._shm.buf, self.slots, self.max_lines,
+                                                      self.words_per_line,
+                                                      _slot_dtype(int(header["gain_n"])))
+        self.poll = poll
+        # next sequence number returned by next(), None - the newest frame
+        self.seq = None
+        self.overruns = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        while True:
+            yield self.next()
+
+    @property
+    def write_seq(self):
+        """Sequence number of the next frame to be published"""
+        return int(self.header["write_seq"])
+
+    def get(self, seq):
+        """Return frame 'seq' as a RingFrame.
+
+        Raises OverrunError if the frame is not in the ring anymore (or yet).
+        """
+        record = self.records[seq % self.slots].copy()
+        if record["seq_end"] != seq:
+            raise OverrunError("Frame %d is not in the ring" % seq)
+        lines = self.data[seq % self.slots, :int(record["nblines"])]
+        lines.flags.writeable = False
+        frame = RingFrame(seq, float(record["timestamp"]), lines, _settings(record))
+        if not self.valid(frame):
+            raise OverrunError("Frame %d was overwritten" % seq)
+        return frame
+
+    def valid(self, frame):
+        """True if 'frame' was not overwritten since get() (or next())"""
+        return int(self.records["seq_begin"][frame.seq % self.slots]) == frame.seq
+
+    def next(self, timeout=None):
+        """Return the frame following the last returned one.
+
+        Starts at the newest frame. Frames overwritten before being read are
+        skipped and counted in 'overruns'. Raises TimeoutError if no frame
+        comes within 'timeout' seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            write_seq = self.write_seq
+            if self.seq is None and write_seq:
+                self.seq = write_seq - 1
+            if self.seq is not None and self.seq < write_seq:
+                # the slot of write_seq may be being overwritten already
+                oldest = max(write_seq - self.slots + 1, 0)
+                if self.seq < oldest:
+                    self.overruns += oldest - self.seq
+                    self.seq = oldest
+                try:
+                    frame = self.get(self.seq)
+                except OverrunError:
+                    continue
+                self.seq += 1
+                return frame
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError("No frame within %.3f s" % timeout)
+            time.sleep(self.poll)
+
+    def close(self):
+        """Detach from the ring. Frames returned so far must not be used anymore"""
+        if self._shm is None:
+            return
+        self.header = self.records = self.data = None
+        self._shm.close()
+        self._shm = None
+
+
+def _slot_dtype(gain_n):
+    """Record of one slot of the ring"""
+    return np.dtype([("seq_begin", "<u8"),
+                     ("seq_end", "<u8"),
+                     ("timestamp", "<f8"),
+                     ("nblines", "<u2"),
+                     ("doublerate", "u1"),
+                     ("t_delay", "<u2"),
+                     ("t_on", "<u2"),
+                     ("t_inter", "<u2"),
+                     ("t_off", "<u2"),
+                     ("dac", "<u2"),
+                     ("gain", "<u2", (gain_n,))], align=True)
+
+
+def _data_offset(slots, slot_dtype):
+    """Offset of the slots data, after the header and records (64 bytes aligned)"""
+    end = FrameRingWriter.HEADER_SIZE + slots * slot_dtype.itemsize
+    return (end + 63) // 64 * 64
+
+
+def _views(buf, slots, max_lines, words_per_line, slot_dtype):
+    """Header, records and data arrays over the shared memory buffer"""
+    header = np.ndarray((), FrameRingWriter.HEADER_DTYPE, buf)
+    records = np.ndarray((slots,), slot_dtype, buf, FrameRingWriter.HEADER_SIZE)
+    data = np.ndarray((slots, max_lines, words_per_line), "<u2", buf,
+                      _data_offset(slots, slot_dtype))
+    return header, records, data
+
+
+def _settings(record):
+    """Settings of a slot record as a dictionnary (like FpgaControl.acq_settings)"""
+    settings = {key: int(record[key]) for key in ("nblines", "doublerate", "t_delay",
+                                                  "t_on", "t_inter", "t_off", "dac")}
+    settings["gain"] = record["gain"].tolist()
+    return settings
+
+
+def _attach(name):
+    """Attach to an existing shared memory block, leaving its lifetime to its creator"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+    # before python 3.13, attached blocks are registered to the resource
+    # tracker, which would unlink them at exit: forget this registration
+    shm = shared_memory.SharedMemory(name=name)
+    if os.name == "posix":
+        resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
@@ -8,8 +8,138 @@
     __license__ = "GPLv3"
     __version__ = "0.1"
 """
+from functools import lru_cache
+
 import numpy as np
 
+# ADC sampling and pulser frequencies (Hz) of the board
+SAMPLE_CLOCK = 64E6
+PULSER_CLOCK = 127.5E6
+
+# Phase order of double rate (DRMODE) acquisitions: odd lines are placed
+# first, see interleave()
+DRMODE_ORDER = (1, 0)
+
+def _phases(double_rate):
+    """Number of sampling phases for a double_rate flag or phases count"""
+    if isinstance(double_rate, (bool, np.bool_)):
+        return 2 if double_rate else 1
+    return max(int(double_rate), 1)
+
+@lru_cache(maxsize=32)
+def _axes(samples, phases, sample_clock):
+    """Read-only (time, frequency) axes, computed once per key"""
+    rate = sample_clock*phases/1E6
+    t = np.arange(samples*phases)/rate
+    f = np.arange(samples*phases)*(rate/(samples*phases))
+    t.flags.writeable = False
+    f.flags.writeable = False
+    return t, f
+
+def acq_time(acq_lines, pulse_periods, samples, sample_clock=SAMPLE_CLOCK,
+             pulser_clock=PULSER_CLOCK):
+    """
+    Duration of an acquisition, in seconds: every line is the pulse sequence
+    followed by the sampling of the line.
+
+    Parameters
+    ----------
+        acq_lines: int
+            Number of acquired lines.
+
+        pulse_periods: int
+            Pulser clock periods of the pulse sequence of one line
+            (INITDEL + PONW + INTERW + POFFW + 4).
+
+        samples: int
+            Number of samples of one acquisition line.
+
+    Return
+    -------
+        float
+            Acquisition duration
+    """
+    return acq_lines * (pulse_periods / pulser_clock + samples / sample_clock)
+
+def time_axis(samples, double_rate=False, sample_clock=SAMPLE_CLOCK):
+    """
+    Time axis of acquisition lines, in us. The arrays are cached and
+    read-only: the same array is returned for the same parameters.
+
+    Parameters
+    ----------
+        samples: int
+            Number of samples of one acquisition line.
+
+        double_rate: Boolean, or int
+            Axis of lines interleaved by process_data (twice the samples at
+            twice the rate), or number of interleaved phases.
+
+        sample_clock: float
+            ADC sampling frequency, in Hz.
+
+    Return
+    -------
+        Numpy array
+            samples*phases times, 1/(sample_clock*phases) apart
+    """
+    return _axes(int(samples), _phases(double_rate), float(sample_clock))[0]
+
+def freq_axis(samples, double_rate=False, sample_clock=SAMPLE_CLOCK):
+    """
+    Frequency axis of the FFT of acquisition lines, in MHz: bin k is at
+    k*sample_rate/points. Cached and read-only, like time_axis().
+
+    Parameters
+    ----------
+        Same as time_axis().
+
+    Return
+    -------
+        Numpy array
+            samples*phases frequencies
+    """
+    return _axes(int(samples), _phases(double_rate), float(sample_clock))[1]
+
+def _is_time_axis(t, samples, sample_clock):
+    """True if "t" holds the values of time_axis(samples)"""
+    axis = time_axis(samples, 1, sample_clock)
+    return t is axis or (t.shape == axis.shape and np.array_equal(t, axis))
+
+def interpolate(arr, factor=2, out=None):
+    """
+    Multiply the size of an array of values by "factor".
+    Inserted values are linearly interpolated between the 2 surrounding
+    values (the last ones repeat the last value).
+
+    Parameters
+    ----------
+        arr: 1D array to be interpolated.
+
+        factor: int
+            Number of values per original value.
+
+        out: optional 1D array of len(arr)*factor values to write into.
+
+    Return
+    -------
+        Numpy array
+            interpolated array, "factor" times the size of "arr"
+    """
+    arr = np.asarray(arr)
+    if out is None:
+        out = np.empty((len(arr)*factor,), dtype=np.result_type(arr.dtype, np.float64))
+    elif out.shape != (len(arr)*factor,):
+        raise ValueError("'out' shape %s, (%d,) expected" % (out.shape, len(arr)*factor))
+    out[0::factor] = arr
+    for phase in range(1, factor):
+        res = out[phase::factor]
+        np.subtract(arr[1:], arr[:-1], out=res[:-1])
+        np.multiply(res[:-1], phase/factor, out=res[:-1])
+        np.add(res[:-1], arr[:-1], out=res[:-1])
+        res[-1] = arr[-1]
+    return out
+
 def interpolate_double(arr):
     """
     Double the size of an array of values.
@@ -24,12 +154,61 @@ def interpolate_double(arr):
         Numpy array
             interpolated array, so double the size of "arr"
     """
-    res = np.empty((len(arr)*2,))
-    res[0::2] = arr
-    res[1::2] = (arr + np.append(arr[1:], (arr[-1])))/2
-    return res
+    return interpolate(arr, 2)
+
+def interleave_average(lines, phases=2, order=None, out=None):
+    """
+    Average and interleave acquisition lines of several sampling phases:
+    line i was sampled at phase i % phases. Lines of every phase are
+    summed and divided by nblines/phases (their average when the lines
+    fill all phases evenly, as interleave() always did), then the phases
+    are interleaved, sample by sample, in "order". With phases=1, lines
+    are just averaged.
+
+    No temporary array is allocated: sums are accumulated in "out".
+
+    Parameters
+    ----------
+        lines: 2D array (lines, samples), or array of arrays.
+
+        phases: int
+            Number of sampling phases (2 for DRMODE).
+
+        order: sequence of the phases, in their order in the result.
+            range(phases) if None (DRMODE_ORDER to match interleave()).
+
+        out: optional 1D array of samples*phases values to write into.
+            Phases without any line are filled with zeros.
+            float32 (or float64) input lines give a result of the same
+            type, other types give float64 results.
+
+    Return
+    ------
+        Numpy array
+            One array of samples*phases averaged and interleaved values.
+    """
+    lines = np.asarray(lines)
+    if lines.ndim != 2:
+        raise ValueError("2D (lines, samples) array expected, got shape %s" % (lines.shape,))
+    nblines, samples = lines.shape
+    if order is None:
+        order = range(phases)
+    if sorted(order) != list(range(phases)):
+        raise ValueError("order %s is not a permutation of the %d phases" % (list(order), phases))
+    if out is None:
+        dtype = lines.dtype if np.issubdtype(lines.dtype, np.floating) else np.float64
+        out = np.empty((samples*phases,), dtype=dtype)
+    elif out.shape != (samples*phases,):
+        raise ValueError("'out' shape %s, (%d,) expected" % (out.shape, samples*phases))
 
-def interleave(arr, odd_first=True):
+    for position, phase in enumerate(order):
+        res = out[position::phases]
+        # zeros for a phase without any line (fewer lines than phases)
+        np.sum(lines[phase::phases], axis=0, out=res)
+        np.divide(res, nblines/phases, out=res)
+    return out
+
+def interleave(arr, odd_first=True, out=None):
     """
     Interleave an array of arrays :
     1. Even arrays are averaged among themselves.
@@ -43,23 +222,18 @@ def interleave(arr, odd_first=True):
         odd_first: Boolean
             The odd arrays will be in odd positions in the result.
 
+        out: optional array to write the result into, see interleave_average.
+
     Return
     ------
         Numpy array
             One array, with the averaged and interleaved data.
             Double the size of arr.
     """
-    res = np.empty((len(arr[0])*2,), dtype=arr[0].dtype)
+    return interleave_average(arr, 2, DRMODE_ORDER if odd_first else (0, 1), out)
 
-    if odd_first:
-        res[0::2] = np.sum(arr[1::2], axis=0)/(len(arr)/2)
-        res[1::2] = np.sum(arr[::2], axis=0)/(len(arr)/2)
-    else:
-        res[0::2] = np.sum(arr[::2], axis=0)/(len(arr)/2)
-        res[1::2] = np.sum(arr[1::2], axis=0)/(len(arr)/2)
-    return res
-
-def process_data(data, interleaved=False):
+def process_data(data, interleaved=False, out=None, phases=2, order=None,
+                 sample_clock=SAMPLE_CLOCK):
     """
     Extract, mean and interleave the data from a measurement.
 
@@ -68,11 +242,23 @@ def process_data(data, interleaved=False):
     data: dict
         Array of measurements arrays.
         data["signal"] Shall contains the measurements arrays
-        data["t"] shall contains the time axis
+        data["t"] may contain the time axis, time_axis() is used if it is
+        missing or equal to time_axis() (as given by get_data, or saved
+        in a capture).
 
     interleaved: Boolean. Indicate if the resulted array shall interleave
-                 or not the measurements. If True, the time axis will
-                 be interpolated.
+                 or not the measurements. If True, the time axis is the
+                 interleaved one (twice the samples at twice the rate).
+
+    out: optional (samples, 2) array to write the result into
+         (samples*phases rows if interleaved).
+
+    phases: int. Number of interleaved sampling phases.
+
+    order: Phases order in the result, DRMODE_ORDER if None and phases is 2
+           (see interleave_average).
+
+    sample_clock: float. ADC sampling frequency of the time axis, in Hz.
 
     Return
     ------
@@ -81,13 +267,28 @@ def process_data(data, interleaved=False):
 
 
     """
-    if interleaved:
-        res_data = interleave(data["signal"])
-        res_time = interpolate_double(data["t"])
-
-    else:
+    signal = np.asarray(data["signal"])
+    if not interleaved:
         # Just mean the acquisition lines between them
-        res_data = np.sum(data["signal"], axis=0)/len(data["signal"])
-        res_time = data["t"]
+        phases = 1
+    elif order is None and phases == 2:
+        order = DRMODE_ORDER
+    line_samples = signal.shape[-1]
+    samples = line_samples*phases
+    if out is None:
+        dtype = signal.dtype if np.issubdtype(signal.dtype, np.floating) else np.float64
+        out = np.empty((samples, 2), dtype=dtype)
+    elif out.shape != (samples, 2):
+        raise ValueError("'out' shape %s, (%d, 2) expected" % (out.shape, samples))
 
-    return np.stack((res_time, res_data), axis=1)
+    interleave_average(signal.reshape(-1, line_samples), phases, order, out[:, 1])
+    t_line = data.get("t")
+    if t_line is not None:
+        t_line = np.asarray(t_line)
+    if t_line is None or _is_time_axis(t_line, line_samples, sample_clock):
+        out[:, 0] = time_axis(line_samples, phases, sample_clock)
+    elif phases > 1:
+        interpolate(t_line, phases, out[:, 0])
+    else:
+        out[:, 0] = t_line
+    return out
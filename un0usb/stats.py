@@ -0,0 +1,81 @@
+'''
+Opt-in instrumentation counters shared by FtdiDevice and FpgaControl
+'''
+
+import threading
+import time
+
+
+class StageStats(object):
+    """Counters of one instrumented stage"""
+
+    __slots__ = ("count", "items", "total", "max", "bytes_in", "bytes_out")
+
+    def __init__(self):
+        self.count = 0
+        self.items = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def as_dict(self):
+        """Return counters as a dictionnary"""
+        return {"count": self.count,
+                "items": self.items,
+                "total_s": self.total,
+                "mean_s": self.total / self.count if self.count else None,
+                "max_s": self.max,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out}
+
+
+class Instrumentation(object):
+    """Per-stage time, count and byte counters, with hook callbacks.
+
+    Stages recorded by the library:
+      - exchange -- USB transfers (items: SPI transactions, bytes in/out);
+      - read_lines -- SRAM readout;
+      - wait -- acquisition completion wait;
+      - acquisition -- whole do_acquisition call;
+      - convert -- raw codes to voltage conversion;
+      - save -- capture saving.
+
+    Hooks are called as hook(stage, elapsed, bytes_in, bytes_out) after
+    every recorded event, from the thread doing the work.
+    """
+
+    def __init__(self, hooks=None):
+        self.hooks = list(hooks or [])
+        self._lock = threading.Lock()
+        self._stages = {}
+        self.started = time.time()
+
+    def record(self, stage, elapsed, bytes_in=0, bytes_out=0, items=1):
+        """Account one event of 'stage' which lasted 'elapsed' seconds"""
+        with self._lock:
+            stats = self._stages.get(stage)
+            if stats is None:
+                stats = self._stages[stage] = StageStats()
+            stats.count += 1
+            stats.items += items
+            stats.total += elapsed
+            if elapsed > stats.max:
+                stats.max = elapsed
+            stats.bytes_in += bytes_in
+            stats.bytes_out += bytes_out
+        for hook in self.hooks:
+            hook(stage, elapsed, bytes_in, bytes_out)
+
+    def snapshot(self):
+        """Return all counters as a dictionnary, by stage"""
+        with self._lock:
+            res = {stage: stats.as_dict() for stage, stats in self._stages.items()}
+        res["uptime_s"] = time.time() - self.started
+        return res
+
+    def reset(self):
+        """Clear all counters"""
+        with self._lock:
+            self._stages = {}
+            self.started = time.time()
@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Streaming of raw acquisitions to local clients over TCP or a Unix
+    socket, instead of polling saved .npz files:
+
+        python3 -m un0usb.stream_server -a 127.0.0.1:5555 -l 32 -d
+        python3 -m un0usb.stream_server -a /tmp/un0rick.sock -u emu://
+
+    Every frame is sent as a "<u4" length, followed by a HEADER_DTYPE
+    header (sequence number, timestamp, pulse settings, gain) and the raw
+    (nblines, words_per_line) "<u2" lines. On connection, a client sends
+    a "<u2" decimation factor (0 - server default): lines are then
+    averaged by blocks of this number of samples. Clients asking for a
+    factor that doesn't divide the line samples are disconnected.
+
+    Every client has a bounded queue: when a client is late, its oldest
+    frames are dropped, and a client blocking a send for more than
+    'send_timeout' seconds is disconnected.
+"""
+import argparse
+import os
+import queue
+import socket
+import stat
+import threading
+import time
+
+import numpy as np
+
+from .acq_pipeline import Frame
+from .csr_map import CsrMap
+
+MAGIC = b"U0FR"
+VERSION = 1
+LENGTH_DTYPE = np.dtype("<u4")
+HELLO_DTYPE = np.dtype("<u2")
+HEADER_DTYPE = np.dtype([("magic", "S4"),
+                         ("version", "<u2"),
+                         ("seq", "<u8"),
+                         ("timestamp", "<f8"),
+                         ("nblines", "<u2"),
+                         ("words_per_line", "<u4"),
+                         ("decimation", "<u2"),
+                         ("doublerate", "u1"),
+                         ("t_delay", "<u2"),
+                         ("t_on", "<u2"),
+                         ("t_inter", "<u2"),
+                         ("t_off", "<u2"),
+                         ("dac", "<u2"),
+                         ("gain", "<u2", (CsrMap.DACGAIN_N,))])
+
+
+def parse_address(address):
+    """Return a (host, port) tuple for 'host:port' strings, else the Unix socket path"""
+    if isinstance(address, str) and ":" in address and not address.startswith("/"):
+        host, port = address.rsplit(":", 1)
+        return (host or "127.0.0.1", int(port))
+    return address
+
+
+def _socket_family(address):
+    return socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+
+
+def _is_socket(path):
+    """True if 'path' is an existing Unix socket file"""
+    try:
+        return stat.S_ISSOCK(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+
+def decimate(lines, factor):
+    """Average 'lines' by blocks of 'factor' samples, as uint16"""
+    if factor <= 1:
+        return lines
+    if lines.shape[-1] % factor:
+        raise ValueError("Decimation factor %d doesn't divide %d samples" % (factor, lines.shape[-1]))
+    blocks = lines.reshape(lines.shape[:-1] + (-1, factor))
+    return (blocks.sum(axis=-1, dtype=np.uint32) + factor // 2) // factor
+
+
+def encode(seq, lines, settings=None, timestamp=None, decimation=1):
+    """Return (length + header bytes, payload array) of one frame"""
+    lines = np.ascontiguousarray(decimate(lines, decimation), dtype="<u2")
+    if lines.ndim == 1:
+        lines = lines[np.newaxis]
+    settings = settings or {}
+    header = np.zeros((), HEADER_DTYPE)
+    header["magic"] = MAGIC
+    header["version"] = VERSION
+    header["seq"] = seq
+    header["timestamp"] = time.time() if timestamp is None else timestamp
+    header["nblines"], header["words_per_line"] = lines.shape
+    header["decimation"] = decimation
+    header["doublerate"] = settings.get("doublerate", 0)
+    for key in ("t_delay", "t_on", "t_inter", "t_off", "dac"):
+        header[key] = settings.get(key, 0)
+    gain = settings.get("gain")
+    header["gain"] = 0 if gain is None else gain
+    length = np.array(HEADER_DTYPE.itemsize + lines.nbytes, dtype=LENGTH_DTYPE)
+    return length.tobytes() + header.tobytes(), lines
+
+
+class StreamFrame(Frame):
+    """One acquisition received by a StreamClient"""
+
+    def __init__(self, seq, timestamp, lines, settings, decimation):
+        super().__init__(seq, timestamp, lines, None)
+        # acquisition settings, like FpgaControl.acq_settings
+        self.settings = settings
+        self.decimation = decimation
+
+
+class _Client(object):
+    """Connection of one client, with its queue and sender thread"""
+
+    def __init__(self, sock, address, queue_size):
+        self.sock = sock
+        self.address = address
+        self.queue = queue.Queue(queue_size)
+        self.decimation = None
+        self.sent = 0
+        self.dropped = 0
+        self.closed = False
+        self.thread = None
+
+
+class StreamServer(object):
+    """Serve published frames to all connected clients"""
+
+    def __init__(self, address=("127.0.0.1", 5555), queue_size=4, decimation=1,
+                 send_timeout=1.0, words_per_line=CsrMap.RAMDATA_N):
+        """Listen on 'address'.
+
+        Keyword arguments:
+         address -- (host, port) for TCP, or a Unix socket path
+                    ('host:port' strings are accepted, see parse_address)
+         queue_size -- frames queued per client before dropping the oldest
+         decimation -- default decimation factor of the clients
+         send_timeout -- seconds a send can block before the client is dropped
+         words_per_line -- samples of the published lines, that decimation
+                           factors must divide
+        """
+        self.address = parse_address(address)
+        self.queue_size = queue_size
+        self.words_per_line = words_per_line
+        if not self.valid_decimation(decimation):
+            raise ValueError("Decimation factor %d doesn't divide %d samples" %
+                             (decimation, words_per_line))
+        self.decimation = decimation
+        self.send_timeout = send_timeout
+        self._sock = socket.socket(_socket_family(self.address), socket.SOCK_STREAM)
+        if _socket_family(self.address) == socket.AF_INET:
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        elif _is_socket(self.address):
+            # left over by a server that was killed
+            os.unlink(self.address)
+        self._sock.bind(self.address)
+        self._sock.listen()
+        self._sock.settimeout(0.1)
+        if _socket_family(self.address) == socket.AF_INET:
+            # actual port, if port 0 was given
+            self.address = self._sock.getsockname()[:2]
+        self._clients = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.seq = 0
+        self.disconnected = 0
+        self._accept_thread = threading.Thread(target=self._accept, name="un0rick-stream",
+                                               daemon=True)
+        self._accept_thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def valid_decimation(self, factor):
+        """True if lines of 'words_per_line' samples can be decimated by 'factor'"""
+        return factor >= 1 and self.words_per_line % factor == 0
+
+    def publish(self, lines, settings=None, timestamp=None):
+        """Send lines (e.g. FpgaControl.do_acquisition result) to all clients.
+
+        The lines are copied: the caller can reuse its buffer right away.
+        Clients whose decimation factor doesn't divide the line samples are
+        disconnected.
+        Return:
+          sequence number of the frame
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        encoded = {}
+        with self._lock:
+            clients = [client for client in self._clients if client.decimation is not None]
+        for client in clients:
+            if client.decimation not in encoded:
+                try:
+                    head, payload = encode(self.seq, lines, settings, timestamp,
+                                           client.decimation)
+                except ValueError:
+                    encoded[client.decimation] = None
+                else:
+                    if payload is lines or np.shares_memory(payload, lines):
+                        payload = payload.copy()
+                    encoded[client.decimation] = (head, payload)
+            message = encoded[client.decimation]
+            if message is None:
+                self._drop(client)
+                continue
+            while True:
+                try:
+                    client.queue.put_nowait(message)
+                    break
+                except queue.Full:
+                    pass
+                try:
+                    client.queue.get_nowait()
+                except queue.Empty:
+                    continue
+                with self._lock:
+                    client.dropped += 1
+        self.seq += 1
+        return self.seq - 1
+
+    def publish_acquisition(self, fpga, lines, timestamp=None):
+        """Send lines acquired by 'fpga' (FpgaControl) with its current settings"""
+        return self.publish(lines, fpga.acq_settings(), timestamp)
+
+    def stats(self):
+        """Return published frames and per client counters as a dictionnary"""
+        with self._lock:
+            clients = [{"address": client.address,
+                        "decimation": client.decimation,
+                        "sent": client.sent,
+                        "dropped": client.dropped,
+                        "queue": client.queue.qsize()} for client in self._clients]
+        return {"published": self.seq,
+                "disconnected": self.disconnected,
+                "clients": clients}
+
+    def close(self):
+        """Disconnect all clients and stop listening"""
+        self._stop.set()
+        self._accept_thread.join()
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            self._drop(client)
+            client.thread.join(1.0)
+        self._sock.close()
+        if _socket_family(self.address) == socket.AF_UNIX and _is_socket(self.address):
+            os.unlink(self.address)
+
+    def _accept(self):
+        """Accept clients until closed"""
+        while not self._stop.is_set():
+            try:
+                sock, address = self._sock.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if _socket_family(self.address) == socket.AF_INET:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client = _Client(sock, address or str(self.address), self.queue_size)
+            client.thread = threading.Thread(target=self._send, args=(client,),
+                                             name="un0rick-stream-client", daemon=True)
+            with self._lock:
+                self._clients += [client]
+            client.thread.start()
+
+    def _send(self, client):
+        """Sender thread of one client: hello, then queued frames"""
+        try:
+            client.sock.settimeout(self.send_timeout)
+            hello = _recv_exactly(client.sock, HELLO_DTYPE.itemsize)
+            decimation = int(np.frombuffer(hello, HELLO_DTYPE)[0]) or self.decimation
+            if not self.valid_decimation(decimation):
+                # rejected: the client gets end of stream
+                raise EOFError("Decimation factor %d doesn't divide %d samples" %
+                               (decimation, self.words_per_line))
+            client.decimation = decimation
+            while not self._stop.is_set() and not client.closed:
+                try:
+                    head, payload = client.queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                client.sock.sendall(head)
+                client.sock.sendall(payload.data)
+                with self._lock:
+                    client.sent += 1
+        except (OSError, EOFError):
+            # closed, or too slow: a send blocked for more than send_timeout
+            pass
+        self._drop(client)
+
+    def _drop(self, client):
+        """Close and forget a client"""
+        with self._lock:
+            if client in self._clients:
+                self._clients.remove(client)
+                if not self._stop.is_set():
+                    self.disconnected += 1
+        client.closed = True
+        try:
+            client.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        client.sock.close()
+
+
+class StreamClient(object):
+    """Receive the frames of a StreamServer"""
+
+    def __init__(self, address=("127.0.0.1", 5555), decimation=0, timeout=None):
+        """Connect to the server.
+
+        Keyword arguments:
+         address -- (host, port), 'host:port' or Unix socket path of the server
+         decimation -- requested decimation factor, 0 - server default
+         timeout -- seconds to wait for a frame before raising socket.timeout
+        """
+        self.address = parse_address(address)
+        self._sock = socket.socket(_socket_family(self.address), socket.SOCK_STREAM)
+        self._sock.connect(self.address)
+        self._sock.settimeout(timeout)
+        self._sock.sendall(np.array(decimation, dtype=HELLO_DTYPE).tobytes())
+        # sequence number of the last frame, to count the frames missed
+        self.seq = None
+        self.missed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        while True:
+            try:
+                yield self.recv()
+            except EOFError:
+                return
+
+    def recv(self):
+        """Return the next StreamFrame. Raises EOFError when the server is gone"""
+        length = int(np.frombuffer(_recv_exactly(self._sock, LENGTH_DTYPE.itemsize), LENGTH_DTYPE)[0])
+        message = _recv_exactly(self._sock, length)
+        header = np.frombuffer(message, HEADER_DTYPE, count=1)[0]
+        if header["magic"] != MAGIC or header["version"] > VERSION:
+            raise ValueError("Not a un0rick frame stream")
+        shape = (int(header["nblines"]), int(header["words_per_line"]))
+        lines = np.frombuffer(message, "<u2", offset=HEADER_DTYPE.itemsize).reshape(shape)
+        seq = int(header["seq"])
+        if self.seq is not None and seq > self.seq + 1:
+            self.missed += seq - self.seq - 1
+        self.seq = seq
+        settings = {key: int(header[key]) for key in ("nblines", "doublerate", "t_delay",
+                                                      "t_on", "t_inter", "t_off", "dac")}
+        settings["gain"] = header["gain"].tolist()
+        return StreamFrame(seq, float(header["timestamp"]), lines, settings,
+                           int(header["decimation"]))
+
+    def close(self):
+        """Disconnect from the server"""
+        self._sock.close()
+
+
+def _recv_exactly(sock, size):
+    """Receive exactly 'size' bytes. Raises EOFError if the connection is closed"""
+    buf = bytearray(size)
+    view = memoryview(buf)
+    while view.nbytes:
+        count = sock.recv_into(view)
+        if not count:
+            raise EOFError("Connection closed")
+        view = view[count:]
+    return buf
+
+
+def serve_acq(fpga, server, acq_lines=32, double_rate=True, gain=None, frames=None):
+    """Acquire continuously and publish every acquisition on 'server'"""
+    lines_buf = fpga.alloc_lines(acq_lines)
+    count = 0
+    while frames is None or count < frames:
+        lines = fpga.do_acquisition(acq_lines=acq_lines, gain=gain, double_rate=double_rate,
+                                    out=lines_buf)
+        server.publish_acquisition(fpga, lines)
+        count += 1
+
+
+if __name__ == "__main__":
+    from .fpga_ctrl import FpgaControl
+
+    PARSER = argparse.ArgumentParser(description="Stream un0rick acquisitions "
+                                                 "to local clients")
+    PARSER.add_argument("-a", "--address",
+                        help="host:port to listen on, or Unix socket path.",
+                        default="127.0.0.1:5555")
+    PARSER.add_argument("-u", "--url",
+                        help="Device url ('emu://' for the emulator).",
+                        default="ftdi://ftdi:2232:/")
+    PARSER.add_argument("-l", "--acqlines",
+                        type=int,
+                        help="Acquisition lines. Shall be from 1 to 32.",
+                        default=32)
+    PARSER.add_argument("-d", "--doublerate",
+                        help="Double rate acquisitions.",
+                        default=False,
+                        action="store_true")
+    PARSER.add_argument("-q", "--queue",
+                        type=int,
+                        help="Frames queued per client before dropping.",
+                        default=4)
+    PARSER.add_argument("-x", "--decimation",
+                        type=int,
+                        help="Default decimation factor of the clients.",
+                        default=1)
+
+    ARGS = PARSER.parse_args()
+    FPGA = FpgaControl(ARGS.url, spi_freq=8E6)
+    FPGA.reload()
+    FPGA.reset()
+    with StreamServer(ARGS.address, ARGS.queue, ARGS.decimation) as SERVER:
+        print("Streaming on %s" % (SERVER.address,))
+        try:
+            serve_acq(FPGA, SERVER, ARGS.acqlines, ARGS.doublerate)
+        except KeyboardInterrupt:
+            pass
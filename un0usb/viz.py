@@ -4,10 +4,13 @@ Wrapper for viz
 
 import numpy as np
 import matplotlib.pyplot as plt
-import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import datetime
 
 from .version import __version__
+from .capture import load_capture
+from .signal_utils import time_axis, freq_axis
 
 
 class FView(object):
@@ -15,12 +18,30 @@ class FView(object):
     SAMPLES_PER_LINE = 16384
     GAINS_MAX = 32
 
+    def __init__(self, reuse=False, blit=False, headless=False):
+        """Keyword arguments:
+          reuse -- keep one figure per report layout, and only update its
+                   line data and title for the next captures. Reports are
+                   then shown without blocking.
+          blit -- with reuse, redraw only the lines and title on screen
+                  (axes limits are kept from the first capture)
+          headless -- draw on Agg canvases outside of pyplot, whatever its
+                      backend (reports are only saved, never shown)
+        """
+        self.reuse = reuse or blit
+        self.blit = blit
+        self.headless = headless
+        # report layout -> figure, lines and axes to update
+        self._templates = {}
+        # (fCentral, bandwidth, points) -> band-pass mask over rfft bins
+        self._masks = {}
+
     def gain_expand(self,gain,DR=False):
         if DR:
             nbPtsLine = self.SAMPLES_PER_LINE*2
         else:
             nbPtsLine = self.SAMPLES_PER_LINE
-        return [gain[x // (nbPtsLine // self.GAINS_MAX)] / 1000.0 for x in range(nbPtsLine)]
+        return np.repeat(np.asarray(gain[:self.GAINS_MAX]) / 1000.0, nbPtsLine // self.GAINS_MAX)
 
     def ptstoline(self,start,stop,DR=False):
         if DR:
@@ -28,7 +49,17 @@ class FView(object):
         else:
             nbPtsLine = self.SAMPLES_PER_LINE
 
-        return [1 if (x >= start and x < stop) else 0 for x in range(nbPtsLine)]
+        line = np.zeros(nbPtsLine, dtype=int)
+        line[max(int(start), 0):max(int(stop), 0)] = 1
+        return line
+
+    def bandpass_mask(self,f,fCentral,bandwidth):
+        """Mask keeping the rfft bins of 'f' within fCentral*(1 +/- bandwidth), cached"""
+        key = (fCentral, bandwidth, len(f))
+        if key not in self._masks:
+            fr = f[:len(f)//2 + 1]
+            self._masks[key] = (fr >= fCentral*(1-bandwidth)) & (fr <= fCentral*(1+bandwidth))
+        return self._masks[key]
 
     def ntons(self,N,DR=False):
         """Converts N units in nanosecs. Not impacted by DR."""
@@ -36,9 +67,9 @@ class FView(object):
 
 
     def readfile(self,npzPath):
-        """Reads NPZ"""
+        """Reads NPZ, with raw ADC codes or voltages"""
 
-        data = np.load(npzPath)
+        data = load_capture(npzPath)
         if (data["nblines"]==32) & (data["doublerate"]==1):
             self.plotNDT(data)
         else:
@@ -49,7 +80,7 @@ class FView(object):
 
     def plotFirst(self,data, show=True, save=True):
  
-        t = data["t"]
+        t = time_axis(len(data["signal"][0]))
         t1 = data["t_delay"]
         t2 = t1 + data["t_on"]
         t3 = t2 + data["t_inter"]
@@ -59,48 +90,28 @@ class FView(object):
         POFF = self.ptstoline(t3,t4)
         m = int(15000//64)
 
-        f = [k*63.75/self.SAMPLES_PER_LINE for k in range(len(data["signal"][0]))]
-
-        FFT = np.abs(np.fft.fft(data["signal"][0]))
+        f = freq_axis(len(data["signal"][0]))
 
-        plt.figure(figsize=(20,10))
-        plt.subplot(2, 1, 1)
+        FFT = np.abs(np.fft.rfft(data["signal"][0]))
+        half = len(data["signal"][0])//2
 
-        plt.plot(t,self.gain_expand(data["gain"]),"y",label="Gain")
-        plt.plot(t,data["signal"][0],"b",label="Signal")
-        plt.plot(t[0:64*5],PON[0:64*5],"g",label="HV Pulse")
-        plt.xlabel("us")
-        plt.ylabel("Amplitude")
-        plt.legend()
         title = str(data["timestamp"])+ ": "+str(data['nblines'])+ " lines.\n"
         title += "Waveform. PulseOn: "+self.ntons(data["t_on"])+"ns, damping of "+self.ntons(data["t_off"])+"ns.\n"
         title += "Python: version "+str(__version__)+". BIN: author:"+str(data["author"])+", version:"+str(data["version"])
 
-        plt.subplot(2, 2, 3)
-        plt.plot(t[0:m],data["signal"][0][0:m],alpha=0.3,label="Signal")
-        plt.plot(t[0:m],PON[0:m],label="Pulse on")
-        plt.plot(t[0:m],POFF[0:m], label="Dampening")
-        plt.title('Pulse waveform')
-        plt.ylabel('V')
-        plt.ylabel('us')
-        plt.legend()
-
-        plt.subplot(2, 2, 4)
-        plt.title('Spectrum composition')
-        plt.plot(f[25:len(FFT)//2],FFT[25:len(FFT)//2])
-        plt.xlabel('Freq (MHz)')
-        plt.ylabel('Energy')
-
-        plt.suptitle(title)
-        plt.tight_layout()
-        if save:
-            plt.savefig(str(data["nameFile"])+".jpg")
-        
-        if show:
-            plt.show()
+        layout = [((2, 1, 1), [(t, self.gain_expand(data["gain"]), "y", {"label": "Gain"}),
+                               (t, data["signal"][0], "b", {"label": "Signal"}),
+                               (t[0:64*5], PON[0:64*5], "g", {"label": "HV Pulse"})],
+                   {"xlabel": "us", "ylabel": "Amplitude"}),
+                  ((2, 2, 3), [(t[0:m], data["signal"][0][0:m], "", {"alpha": 0.3, "label": "Signal"}),
+                               (t[0:m], PON[0:m], "", {"label": "Pulse on"}),
+                               (t[0:m], POFF[0:m], "", {"label": "Dampening"})],
+                   {"title": "Pulse waveform", "xlabel": "us", "ylabel": "V"}),
+                  ((2, 2, 4), [(f[25:half], FFT[25:half], "", {})],
+                   {"title": "Spectrum composition", "xlabel": "Freq (MHz)", "ylabel": "Energy"})]
 
-        plt.close()
-        plt.clf()
+        self._render("first", layout, title,
+                     str(data["nameFile"])+".jpg" if save else None, show)
 
     def plotNDT(self,data,fCentral=None,bandwidth=None,
                 show=True, save=True):
@@ -118,83 +129,150 @@ class FView(object):
 
             # Interleave data, so create a new matrix, double the size
             # of the original signal
-            signal = np.empty((len(data["signal"][0])*2,),
-                              dtype=data["signal"][0].dtype)
+            lines = np.asarray(data["signal"])
+            signal = np.empty((lines.shape[1]*2,), dtype=lines.dtype)
 
             # Compute even and odd datas.
-            signal[0::2] = np.sum(data["signal"][::2], axis=0)/(data["nblines"]/2)
-            signal[1::2] = np.sum(data["signal"][1::2], axis=0)/(data["nblines"]/2)
-
-            t = [T*63.75*4/len(signal) for T in range(len(signal))]
-            f = [2*k*63.75/Npts for k in range(Npts)]
-
-            rawSignal = np.array(signal, copy=True)  
-            FFT = np.abs(np.fft.fft(signal))
-            if fCentral and bandwidth:
-                FFT_clean = np.fft.fft(signal)
-                N = len(f)//2
-                for i in range(N+1):
-                    if f[i] < (fCentral*(1-bandwidth)) or f[i]> (fCentral*(1+bandwidth)):
-                        FFT_clean[i] = 0
-                        FFT_clean[-i] = 0
-                signal = np.real(np.fft.ifft(FFT_clean))
-                msignal = np.max(np.abs(signal))
-                signal = [float(x/msignal) for x in signal]
-
-            plt.figure(figsize=(20,10))
-            plt.subplot(2, 1, 1)
-
-            plt.plot(t,self.gain_expand(data["gain"],DR=True),"y",label="Gain")
-            
-            if fCentral and bandwidth:
-                plt.plot(t,rawSignal,"b",label="Raw signal" ,alpha = 0.3)
-                plt.plot(t,signal,"r",label="Filtered signal (normalized)")
-            else:
-                plt.plot(t,signal,"b",label="Signal")
+            signal[0::2] = np.sum(lines[::2], axis=0)/(data["nblines"]/2)
+            signal[1::2] = np.sum(lines[1::2], axis=0)/(data["nblines"]/2)
+
+            t = time_axis(self.SAMPLES_PER_LINE, True)
+            f = freq_axis(self.SAMPLES_PER_LINE, True)
+
+            rawSignal = signal
+            spectrum = np.fft.rfft(signal)
+            FFT = np.abs(spectrum)
+            filtered = bool(fCentral and bandwidth)
+            if filtered:
+                # band-pass: zero all bins out of the band
+                FFT_clean = spectrum * self.bandpass_mask(f, fCentral, bandwidth)
+                signal = np.fft.irfft(FFT_clean, n=Npts)
+                signal /= np.max(np.abs(signal))
 
-            plt.plot(t[0:64*5],PON[0:64*5],"g",label="HV Pulse")
-            plt.xlim(0, 50) 
-            plt.xlabel("us")
-            plt.ylabel("Amplitude")
-            plt.legend()
             title = str(data["timestamp"])+ ": "+str(data['nblines'])+ " lines.\n"
             title += "NDT averaged waveform (first 50us). PulseOn: "+self.ntons(data["t_on"])+"ns, damping of "+self.ntons(data["t_off"])+"ns.\n"
             title += "Python: saved version "+str(__version__)+" (saved with "+str(data["libversion"])+"). BIN: author:"+str(data["author"])+", version:"+str(data["version"])
 
-            plt.subplot(2, 2, 3)
-            if fCentral and bandwidth:
-                plt.plot(t[0:m],rawSignal[0:m],"b",label="Raw signal" ,alpha = 0.1)
-                plt.plot(t[0:m],signal[0:m],"r",label="Filtered signal (normalized)",alpha=0.3)
+            if filtered:
+                top = [(t, rawSignal, "b", {"label": "Raw signal", "alpha": 0.3}),
+                       (t, signal, "r", {"label": "Filtered signal (normalized)"})]
+                zoom = [(t[0:m], rawSignal[0:m], "b", {"label": "Raw signal", "alpha": 0.1}),
+                        (t[0:m], signal[0:m], "r", {"label": "Filtered signal (normalized)", "alpha": 0.3})]
+                spectra = [(f[50:Npts//2], FFT[50:Npts//2], "", {}),
+                           (f[50:Npts//2], np.abs(FFT_clean)[50:Npts//2], "", {})]
             else:
-                plt.plot(t[0:m],signal[0:m],"b",label="Signal") 
-            plt.plot(t[0:m],PON[0:m],label="Pulse on")
-            plt.plot(t[0:m],POFF[0:m], label="Dampening")
-            plt.title('Pulse waveform')
-            plt.ylabel('V')
-            plt.ylabel('us')
-            plt.legend()
-
-            plt.subplot(2, 2, 4)
-            plt.title('Spectrum composition')
-            plt.plot(f[50:len(FFT)//2],FFT[50:len(FFT)//2])
-            if fCentral:
-                if bandwidth:
-                    plt.plot(f[50:len(FFT_clean)//2],np.abs(FFT_clean)[50:len(FFT_clean)//2])
-            plt.xlabel('Freq (MHz)')
-            plt.ylabel('Energy')
-
-            plt.suptitle(title)
-            plt.tight_layout()
-
-            if save:
-                plt.savefig(str(data["nameFile"])+"_ndt.jpg")
-        
+                top = [(t, signal, "b", {"label": "Signal"})]
+                zoom = [(t[0:m], signal[0:m], "b", {"label": "Signal"})]
+                spectra = [(f[50:Npts//2], FFT[50:Npts//2], "", {})]
+
+            layout = [((2, 1, 1), [(t, self.gain_expand(data["gain"],DR=True), "y", {"label": "Gain"})] + top +
+                                  [(t[0:64*5], PON[0:64*5], "g", {"label": "HV Pulse"})],
+                       {"xlabel": "us", "ylabel": "Amplitude", "xlim": (0, 50)}),
+                      ((2, 2, 3), zoom + [(t[0:m], PON[0:m], "", {"label": "Pulse on"}),
+                                          (t[0:m], POFF[0:m], "", {"label": "Dampening"})],
+                       {"title": "Pulse waveform", "xlabel": "us", "ylabel": "V"}),
+                      ((2, 2, 4), spectra,
+                       {"title": "Spectrum composition", "xlabel": "Freq (MHz)", "ylabel": "Energy"})]
+
+            self._render(("ndt", filtered), layout, title,
+                         str(data["nameFile"])+"_ndt.jpg" if save else None, show)
+
+        else:
+            print("Conditions - 32 lines & double rate - not met for this plot.")
+
+    def _render(self, key, layout, title, path, show):
+        """Draw a report, from its template if figures are reused.
+
+        'layout' lists the subplots as (position, curves, labels) with curves
+        as (x, y, fmt, plot kwargs) and labels a dict of title, xlabel,
+        ylabel and xlim. Reports of one 'key' must share the same layout.
+        """
+        show = show and not self.headless
+        if not self.reuse:
+            fig, _, _, _ = self._build(layout, title)
+            if path:
+                fig.savefig(path)
             if show:
                 plt.show()
-            
-            plt.close()
-            plt.clf()
+            if not self.headless:
+                plt.close(fig)
+            return
+
+        tpl = self._templates.get(key)
+        if tpl is None or not (self.headless or plt.fignum_exists(tpl["fig"].number)):
+            fig, lines, axes, text = self._build(layout, title)
+            tpl = self._templates[key] = {"fig": fig, "lines": lines, "axes": axes,
+                                          "title": text, "background": None}
+        else:
+            curves = [curve for _, subplot_curves, _ in layout for curve in subplot_curves]
+            for line, (x, y, _, _) in zip(tpl["lines"], curves):
+                line.set_data(x, y)
+            tpl["title"].set_text(title)
+            if not self.blit:
+                for ax, (_, _, labels) in zip(tpl["axes"], layout):
+                    ax.relim()
+                    ax.autoscale_view()
+                    if "xlim" in labels:
+                        ax.set_xlim(*labels["xlim"])
+        if path:
+            tpl["fig"].savefig(path)
+        if show:
+            self._show(tpl)
 
+    def _build(self, layout, title):
+        """Create a report figure. Return (figure, lines, axes, title text)"""
+        if self.headless:
+            fig = Figure(figsize=(20,10))
+            FigureCanvasAgg(fig)
         else:
-            print("Conditions - 32 lines & double rate - not met for this plot.")
-     
+            fig = plt.figure(figsize=(20,10))
+        lines = []
+        axes = []
+        for position, curves, labels in layout:
+            ax = fig.add_subplot(*position)
+            for x, y, fmt, kwargs in curves:
+                lines += ax.plot(x, y, fmt, **kwargs)
+            if "title" in labels:
+                ax.set_title(labels["title"])
+            ax.set_xlabel(labels.get("xlabel", ""))
+            ax.set_ylabel(labels.get("ylabel", ""))
+            if "xlim" in labels:
+                ax.set_xlim(*labels["xlim"])
+            if any(kwargs.get("label") for _, _, _, kwargs in curves):
+                ax.legend()
+            axes += [ax]
+        text = fig.suptitle(title)
+        fig.tight_layout()
+        return fig, lines, axes, text
+
+    def _show(self, tpl):
+        """Update a template figure on screen, without blocking"""
+        fig = tpl["fig"]
+        canvas = fig.canvas
+        if self.blit and getattr(canvas, "supports_blit", False):
+            artists = tpl["lines"] + [tpl["title"]]
+            if tpl["background"] is None:
+                plt.show(block=False)
+                # background: the figure without the updated artists
+                for artist in artists:
+                    artist.set_visible(False)
+                canvas.draw()
+                tpl["background"] = canvas.copy_from_bbox(fig.bbox)
+                for artist in artists:
+                    artist.set_visible(True)
+            canvas.restore_region(tpl["background"])
+            for artist in artists:
+                fig.draw_artist(artist)
+            canvas.blit(fig.bbox)
+            canvas.flush_events()
+        else:
+            canvas.draw_idle()
+            plt.show(block=False)
+            plt.pause(0.001)
+
+    def close(self):
+        """Close the template figures"""
+        for tpl in self._templates.values():
+            if not self.headless:
+                plt.close(tpl["fig"])
+        self._templates = {}